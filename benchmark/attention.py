@@ -0,0 +1,166 @@
+### Check the fast paths of the attention layers against the reference ones and time them
+### python -m benchmark.attention [--device cuda]
+import argparse
+import time
+import torch
+from models.modules.attention import RelPosMHAXL, RelPosEncXL
+from models.modules.transformer_encoder_cross import TransformerEncoderCross
+
+
+def timeit(fn, iters, device):
+    """
+    The average ms per call of fn after a few warm-up calls
+    """
+    for _ in range(3):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) * 1000 / iters
+
+
+def check(name, ref, fast, args):
+    """
+    Print the max abs difference of the fast path to the reference one and fail if it is not within
+    atol + rtol * max abs of the reference
+    """
+    diff = (ref - fast).abs().max().item()
+    tol = args.atol + args.rtol * ref.abs().max().item()
+    print(f"{name} max abs diff: {diff:.2e} (tolerance {tol:.2e})")
+    assert diff <= tol, f"{name}: the fast path differs from the reference by {diff:.2e}"
+
+
+def check_relpos(args, device):
+    """
+    RelPosMHAXL without weights (scaled_dot_product_attention) against the reference path,
+    for self-attention, for a shorter query with masks and for the gradients
+    """
+    torch.manual_seed(0)
+    net = RelPosMHAXL(args.d_model, args.nhead).to(device)
+    pos_enc = RelPosEncXL(args.d_model).to(device)
+    x = torch.randn(args.batch, args.length, args.d_model, device=device)
+    q = torch.randn(args.batch, args.length // 2, args.d_model, device=device)
+    key_padding_mask = torch.zeros(args.batch, args.length, dtype=torch.bool, device=device)
+    key_padding_mask[0, -args.length // 4 :] = True
+    attn_mask = torch.rand(args.length // 2, args.length, device=device) > 0.9
+    attn_mask[:, 0] = False
+    pos = pos_enc(x)
+
+    net.eval()
+    with torch.no_grad():
+        ref, _ = net(x, x, x, pos)
+        fast = net(x, x, x, pos, return_attn_weights=False, self_attention=True)
+        check("RelPosMHAXL self-attention", ref, fast, args)
+        ref, _ = net(
+            q, x, x, pos, key_padding_mask=key_padding_mask, attn_mask=attn_mask
+        )
+        fast = net(
+            q,
+            x,
+            x,
+            pos,
+            key_padding_mask=key_padding_mask,
+            attn_mask=attn_mask,
+            return_attn_weights=False,
+        )
+        check("RelPosMHAXL cross-attention with masks", ref, fast, args)
+
+    ## every parameter gets a gradient on both paths, the ones of pos_bias_v and linear_pos
+    ## flow through the additive mask of scaled_dot_product_attention on the fast path
+    net.train()
+    grads = {}
+    for weights in [True, False]:
+        net.zero_grad(set_to_none=True)
+        out = net(q, x, x, pos, return_attn_weights=weights)
+        out = out[0] if weights else out
+        out.square().sum().backward()
+        grads[weights] = {n: p.grad for n, p in net.named_parameters()}
+    for name, _ in net.named_parameters():
+        ref, fast = grads[True][name], grads[False][name]
+        assert ref is not None, f"no gradient of {name} on the reference path"
+        assert fast is not None, f"no gradient of {name} on the fast path"
+        check(f"RelPosMHAXL gradient of {name}", ref, fast, args)
+
+    net.eval()
+    with torch.no_grad():
+        t_ref = timeit(lambda: net(x, x, x, pos_enc(x)), args.iters, device)
+        t_fast = timeit(
+            lambda: net(
+                x, x, x, pos_enc(x), return_attn_weights=False, self_attention=True
+            ),
+            args.iters,
+            device,
+        )
+    print(f"RelPosMHAXL reference: {t_ref:.2f} ms, fast: {t_fast:.2f} ms")
+
+    ## the cached keys and values of a reference shared by the batch
+    torch.manual_seed(0)
+    net = RelPosMHAXL(args.d_model, args.nhead, vbias=True).to(device)
+    ## the value bias starts at zero, make it count
+    torch.nn.init.normal_(net.value_bias_weight, std=0.02)
+    net.eval()
+    regi = x[:1]
+    with torch.no_grad():
+        ref = net(
+            q, regi.expand_as(x), regi.expand_as(x), pos, return_attn_weights=False
+        )
+        cached = net(
+            q, None, None, pos, return_attn_weights=False, kv=net.project_kv(regi, regi)
+        )
+    check("RelPosMHAXL cached keys and values", ref, cached, args)
+
+
+def check_fusion(args, device):
+    """
+    The fusion of config/tselm_l.yaml (4 layers of regularMHA) with and without the attention maps
+    """
+    torch.manual_seed(0)
+    net = TransformerEncoderCross(
+        num_layers=4, nhead=args.nhead, d_ffn=1024, d_model=args.d_model
+    ).to(device)
+    net.eval()
+    mix = torch.randn(args.batch, args.length, args.d_model, device=device)
+    regi = torch.randn(args.batch, args.length, args.d_model, device=device)
+    with torch.no_grad():
+        ref, attn = net(mix, regi, return_attention=True)
+        fast, _ = net(mix, regi)
+        assert len(attn) == len(net.layers)
+        check("fusion without attention maps", ref, fast, args)
+        t_ref = timeit(lambda: net(mix, regi, return_attention=True), args.iters, device)
+        t_fast = timeit(lambda: net(mix, regi), args.iters, device)
+    ## with the maps is the path of the fusion before the batch first attention without weights
+    print(
+        f"fusion on {device.type} with attention maps: {t_ref:.2f} ms, without: {t_fast:.2f} ms, "
+        f"speedup {t_ref / t_fast:.2f}x ({torch.__version__}, {torch.get_num_threads()} threads)"
+    )
+
+    ## the reference keys and values projected once, shared by all the chunks of a speaker
+    regi = regi[:1]
+    with torch.no_grad():
+        ref, _ = net(mix, regi.expand_as(mix))
+        kv = net.project_kv(regi)
+        cached, _ = net(mix, None, kv=kv)
+        check("fusion with cached keys and values", ref, cached, args)
+        t_ref = timeit(lambda: net(mix, regi.expand_as(mix)), args.iters, device)
+        t_fast = timeit(lambda: net(mix, None, kv=kv), args.iters, device)
+    print(f"fusion projecting the reference: {t_ref:.2f} ms, cached: {t_fast:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--length", type=int, default=150)
+    parser.add_argument("--d_model", type=int, default=1024)
+    parser.add_argument("--nhead", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    check_relpos(args, device)
+    check_fusion(args, device)
@@ -1,9 +1,13 @@
 import os.path as op
 import os
 import glob
+import json
 import torch
+import torchaudio
 import tqdm
 import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 BASE_PATH = "."
 
@@ -12,29 +16,125 @@ def p(*args):
     return op.join(BASE_PATH, *args)
 
 
-def generate_training_pt(train_100: str, train_360: str):
+def probe(path: str):
+    """
+    Return [path, num_frames, sample_rate] of an audio file by reading its header only
+    """
+    info = torchaudio.info(path)
+    return [path, info.num_frames, info.sample_rate]
+
+
+def probe_dir(directory: str):
+    """
+    Probe all the .flac files of a LibriSpeech chapter directory
+    """
+    files = sorted(glob.glob(op.join(directory, "*.flac")))
+    return [probe(f) for f in files]
+
+
+def scan_dirs(roots, num_workers):
+    """
+    Return {chapter_dir: mtime} of all <root>/<speaker>/<chapter> directories.
+    The speaker directories are scanned in parallel.
+    """
+
+    def _scan(spk_dir):
+        return [
+            (e.path, e.stat().st_mtime) for e in os.scandir(spk_dir) if e.is_dir()
+        ]
+
+    spk_dirs = [e.path for r in roots for e in os.scandir(r) if e.is_dir()]
+    chapters = {}
+    with ThreadPoolExecutor(num_workers) as pool:
+        for res in pool.map(_scan, spk_dirs):
+            chapters.update(res)
+    return chapters
+
+
+def load_index(index_path: str):
+    """
+    The index is a json lines file of {"dir", "mtime", "files"}, the last record of a directory wins.
+    """
+    index = {}
+    if not op.exists(index_path):
+        return index
+    with open(index_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                ## a partially written last line of an interrupted run
+                continue
+            index[record["dir"]] = record
+    return index
+
+
+def generate_training_pt(train_100: str, train_360: str, num_workers: int):
     print("generate training scp")
-    spk_dict = {}
-    train_audio = [train_100, train_360]
-    for t in train_audio:
-        audio_files = glob.glob(op.join(t, "*", "*", "*.flac"))
-        for a in tqdm.tqdm(audio_files):
-            spk = a.split("/")[-3]
-            if spk in spk_dict:
-                spk_dict[spk] = spk_dict[spk] + [a]
-            else:
-                spk_dict[spk] = [a]
-    torch.save(spk_dict, p("list", "train", "train_100_360.pt"))
+    index_path = p("list", "train", "train_100_360.index.jsonl")
+    chapters = scan_dirs([train_100, train_360], num_workers)
+    index = load_index(index_path)
+    todo = [
+        d
+        for d, mtime in chapters.items()
+        if d not in index or index[d]["mtime"] != mtime
+    ]
+    print(f"{len(chapters)} directories, {len(todo)} new or changed")
+    ## probe the changed directories in a process pool and append to the index as they finish
+    with ProcessPoolExecutor(num_workers) as pool, open(index_path, "a") as f:
+        for d, files in tqdm.tqdm(
+            zip(todo, pool.map(probe_dir, todo, chunksize=4)), total=len(todo)
+        ):
+            record = {"dir": d, "mtime": chapters[d], "files": files}
+            index[d] = record
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+    spk_dict = defaultdict(list)
+    with open(p("list", "train", "train_100_360.len"), "w") as f:
+        for d in sorted(chapters.keys()):
+            spk = op.basename(op.dirname(d))
+            for a, num_frames, _ in index[d]["files"]:
+                spk_dict[spk].append(a)
+                f.write(f"{a} {num_frames}\n")
+    torch.save(dict(spk_dict), p("list", "train", "train_100_360.pt"))
     print("done!")
 
 
-def generate_scp(dataset_name: str, type: str, name: str):
+def load_scp_index(name: str):
+    """
+    {type: mtime} of the libri2mix directories the lists of name were generated from
+    """
+    index_path = p("list", name, "scp.index.json")
+    if not op.exists(index_path):
+        return {}
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+def generate_scp(dataset_name: str, type: str, name: str, pool, index):
+    """
+    Generate <type>.scp and <type>.len which has the number of samples of each audio.
+    They are kept if the directory did not change since the last run, according to index.
+    """
+    directory = op.join(dataset_name, type)
+    mtime = os.stat(directory).st_mtime
+    scp_path = p("list", name, f"{type}.scp")
+    len_path = p("list", name, f"{type}.len")
+    if index.get(type) == mtime and op.exists(scp_path) and op.exists(len_path):
+        print(f"{name} {type} unchanged, skipped")
+        return
     print(f"generating scp for {name} of type {type}")
-    files = sorted(glob.glob(p(dataset_name, type, "*.wav")))
+    files = sorted(glob.glob(op.join(directory, "*.wav")))
     res = [f"{i.split('/')[-1]} {i}\n" for i in files]
-    with open(p("list", name, f"{type}.scp"), "w") as f:
+    with open(scp_path, "w") as f:
         for r in res:
             f.write(r)
+    with open(len_path, "w") as f:
+        for i, (_, num_frames, _) in zip(files, pool.map(probe, files, chunksize=64)):
+            f.write(f"{i.split('/')[-1]} {num_frames}\n")
+    index[type] = mtime
+    with open(p("list", name, "scp.index.json"), "w") as f:
+        json.dump(index, f)
     print("done")
 
 
@@ -45,14 +145,18 @@ if __name__ == "__main__":
     parser.add_argument("-lm_dev", "--libri2mix_dev", type=str, required=True)
     parser.add_argument("-lm_test", "--libri2mix_test", type=str, required=True)
     parser.add_argument("-o", "--output", type=str, required=True)
+    parser.add_argument(
+        "-j",
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of processes to probe the audio files.",
+    )
     args = parser.parse_args()
 
     BASE_PATH = args.output
 
-    if op.exists(p("list")):
-        raise FileExistsError(
-            "Please choose another folder that does not have folder 'list' as output folder."
-        )
+    ## an existing list folder is updated incrementally
     os.makedirs(p("list"), exist_ok=True)
     os.makedirs(p("list", "train"), exist_ok=True)
     os.makedirs(p("list", "libri2mix_dev"), exist_ok=True)
@@ -61,9 +165,13 @@ if __name__ == "__main__":
     dev_audio = args.libri2mix_dev
     test_audio = args.libri2mix_test
 
-    generate_training_pt(args.librispeech_train_100, args.librispeech_train_360)
+    generate_training_pt(
+        args.librispeech_train_100, args.librispeech_train_360, args.num_workers
+    )
 
-    for t in ["aux_s1", "mix_clean", "s1"]:
+    with ProcessPoolExecutor(args.num_workers) as pool:
         for d, n in [(dev_audio, "libri2mix_dev"), (test_audio, "libri2mix_test")]:
-            generate_scp(d, t, n)
+            index = load_scp_index(n)
+            for t in ["aux_s1", "mix_clean", "s1"]:
+                generate_scp(d, t, n, pool, index)
     print("All scp files are generated successfully!")
@@ -1,9 +1,15 @@
+import math
+import os
+import os.path as op
+import json
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import random
 import torchaudio
 from utils.wav import truc_wav
-from utils.load_scp import get_source_list
+import torch.nn.functional as F
+from utils.load_scp import get_source_list, get_source_lengths
 
 
 def _activelev(*args):
@@ -20,14 +26,15 @@ def unify_energy(*args):
     return [x * mix_scale for x in args]
 
 
-def generate_target_audio(spk1, spk2, regi, snr=5):
+def generate_target_audio(spk1, spk2, regi, snr=5, rng=None):
     """
     spk 1: T1
     spk 2: T2
     regi: T3
+    rng: the random.Random to sample the snr from, the global random module if None
     """
     spk1, spk2 = unify_energy(spk1, spk2)
-    snr_1 = random.random() * snr / 2
+    snr_1 = (random if rng is None else rng).random() * snr / 2
     snr_2 = -snr_1
     spk1 = spk1 * 10 ** (snr_1 / 20)
     spk2 = spk2 * 10 ** (snr_2 / 20)
@@ -36,6 +43,82 @@ def generate_target_audio(spk1, spk2, regi, snr=5):
     return (mix, clean, regi)
 
 
+def unify_energy_batch(*args):
+    """
+    Batched version of unify_energy.
+    Each argument is [B, T_i]; every row is scaled by the peak amplitude of that row across all arguments.
+    """
+    max_amp = torch.stack([x.abs().amax(dim=1) for x in args]).amax(dim=0)  # [B]
+    mix_scale = (1.0 / max_amp).unsqueeze(1)  # [B, 1]
+    return [x * mix_scale for x in args]
+
+
+def counter_rng(key):
+    """
+    Return a random.Random which is a pure function of the key,
+    e.g. (seed, epoch, index) so that any example of the stream can be reproduced on its own.
+    If key is not a tuple (a regular sampler index), return the global random module.
+    """
+    if not isinstance(key, tuple):
+        return random
+    return random.Random("/".join(str(k) for k in key))
+
+
+def collate_sources(batch):
+    """
+    Collate function for TargetDMDataset with mix_on_device=True.
+    Stacks the raw (spk1, spk2, regi) crops into [B, T] tensors to be mixed by DynamicMixer.
+    """
+    spk1, spk2, regi = zip(*batch)
+    return torch.stack(spk1), torch.stack(spk2), torch.stack(regi)
+
+
+class DynamicMixer:
+    def __init__(self, snr=5, seed=1234, device="cpu"):
+        """
+        Batched counterpart of generate_target_audio that runs on the training device.
+        SNR sampling, energy normalization and mixing are done for the whole batch at once.
+
+        Args:
+            snr: the SNR range, the same as in generate_target_audio
+            seed: the seed of the generator used to sample the SNR
+            device: the device the sources will be on
+        """
+        self.snr = snr
+        self.seed = seed
+        self.generator = torch.Generator(device=device).manual_seed(seed)
+
+    @torch.no_grad()
+    def __call__(self, spk1, spk2, regi, step=None):
+        """
+        spk1: [B, T1]
+        spk2: [B, T1]
+        regi: [B, T2]
+        step: if given, the generator is reseeded from (seed, step) so that the mixing of a batch
+            does not depend on the previous ones, e.g. after resuming. With gradient accumulation,
+            it should be the index of the micro-batch, so that the micro-batches of a step differ
+        return (mix, clean, regi) the same as generate_target_audio but batched
+        """
+        if step is not None:
+            self.generator.manual_seed((self.seed << 32) + step)
+        spk1, spk2 = unify_energy_batch(spk1, spk2)
+        snr_1 = (
+            torch.rand(
+                spk1.size(0),
+                generator=self.generator,
+                device=spk1.device,
+                dtype=spk1.dtype,
+            )
+            * self.snr
+            / 2
+        ).unsqueeze(1)  # [B, 1]
+        spk1 = spk1 * 10 ** (snr_1 / 20)
+        spk2 = spk2 * 10 ** (-snr_1 / 20)
+        mix = spk1 + spk2
+        mix, clean, regi = unify_energy_batch(mix, spk1, regi)
+        return (mix, clean, regi)
+
+
 class TargetDMDataset(Dataset):
     def __init__(
         self,
@@ -44,6 +127,7 @@ class TargetDMDataset(Dataset):
         epoch_num=100000,
         mix_length=48080,
         regi_length=64080,
+        mix_on_device=False,
     ):
         """
         Initialize the Target DM Dataset.
@@ -55,6 +139,8 @@ class TargetDMDataset(Dataset):
             epoch_num: specifcy how many data to be considered as one epoch
             mix_length: the length of the mixing speech and clean speech
             regi_length: the length of the register speech
+            mix_on_device: if True, return the raw (spk1, spk2, regi) crops instead of the mixture,
+                which are mixed for the whole batch by DynamicMixer in the trainer
         """
         self.speaker_dict = torch.load(scp_path)
         self.length = epoch_num
@@ -62,35 +148,211 @@ class TargetDMDataset(Dataset):
         self.rank = rank
         self.regi_length = regi_length
         self.num = 3
+        self.mix_on_device = mix_on_device
         pass
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, idx):
+        """
+        idx: an index from a regular sampler, which draws from the global random module,
+            or a (seed, epoch, index) key from DMStreamSampler, which makes the example a pure function of the key
+        """
+        rng = counter_rng(idx)
         keys_list = list(self.speaker_dict.keys())
-        speaker_1 = random.choice(keys_list)
-        speaker_2 = random.choice(keys_list)
+        speaker_1 = rng.choice(keys_list)
+        speaker_2 = rng.choice(keys_list)
         while speaker_2 == speaker_1:
-            speaker_2 = random.choice(keys_list)
-        spk1 = random.choice(self.speaker_dict[speaker_1])
-        regi = random.choice(self.speaker_dict[speaker_1])
+            speaker_2 = rng.choice(keys_list)
+        spk1 = rng.choice(self.speaker_dict[speaker_1])
+        regi = rng.choice(self.speaker_dict[speaker_1])
         while regi == spk1:
-            regi = random.choice(self.speaker_dict[speaker_1])
-        spk2 = random.choice(self.speaker_dict[speaker_2])
+            regi = rng.choice(self.speaker_dict[speaker_1])
+        spk2 = rng.choice(self.speaker_dict[speaker_2])
         spk1_audio = torchaudio.load(spk1)[0].squeeze(0)  # [T]
         spk2_audio = torchaudio.load(spk2)[0].squeeze(0)
         regi_audio = torchaudio.load(regi)[0].squeeze(0)
         if self.regi_length is not None:
-            regi_audio = truc_wav(regi_audio, length=self.regi_length)
+            regi_audio = truc_wav(regi_audio, length=self.regi_length, rng=rng)
         else:
-            regi_audio = truc_wav(regi_audio, length=self.mix_length)
-        spk1_audio = truc_wav(spk1_audio, length=self.mix_length)
-        spk2_audio = truc_wav(spk2_audio, length=self.mix_length)
-        mix, clean, regi = generate_target_audio(spk1_audio, spk2_audio, regi_audio)
+            regi_audio = truc_wav(regi_audio, length=self.mix_length, rng=rng)
+        spk1_audio = truc_wav(spk1_audio, length=self.mix_length, rng=rng)
+        spk2_audio = truc_wav(spk2_audio, length=self.mix_length, rng=rng)
+        if self.mix_on_device:
+            return spk1_audio, spk2_audio, regi_audio
+        mix, clean, regi = generate_target_audio(
+            spk1_audio, spk2_audio, regi_audio, rng=rng
+        )
         return mix, clean, regi
 
 
+class DMStreamSampler(Sampler):
+    def __init__(self, dataset, rank, world_size, seed=1234):
+        """
+        Counter-based sampler for TargetDMDataset.
+        Yields (seed, epoch, index) keys where index is sharded across ranks like DistributedSampler,
+        so example i of epoch e is a pure function of (seed, epoch, i). The stream can be positioned
+        anywhere in the epoch with seek() without loading the skipped examples.
+
+        Args:
+            dataset: the TargetDMDataset
+            seed: the sampling seed shared by all ranks
+        """
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.num_samples = math.ceil(len(dataset) / world_size)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def seek(self, num_samples):
+        """
+        Skip the first num_samples examples of this rank in the current epoch.
+        """
+        self.start = num_samples
+
+    def __iter__(self):
+        for i in range(self.start, self.num_samples):
+            yield (self.seed, self.epoch, self.rank + i * self.world_size)
+
+    def __len__(self):
+        return self.num_samples
+
+
+class TargetDMPoolDataset(TargetDMDataset):
+    def __init__(
+        self,
+        scp_path,
+        rank,
+        epoch_num=100000,
+        mix_length=48080,
+        regi_length=64080,
+    ):
+        """
+        Dynamic mixing dataset for utterance reuse.
+        Each item is indexed by a speaker and returns one (utt, regi) pair of that speaker,
+        SpeakerPoolBatchSampler draws a pool of distinct speakers per batch and MultiplexCollate
+        forms several target/interferer/reference combinations from the pool.
+
+        Args:
+            the same as TargetDMDataset, epoch_num still counts the mixtures of one epoch
+        """
+        super().__init__(
+            scp_path,
+            rank,
+            epoch_num=epoch_num,
+            mix_length=mix_length,
+            regi_length=regi_length,
+            mix_on_device=True,
+        )
+        self.speakers = list(self.speaker_dict.keys())
+
+    def __getitem__(self, idx):
+        """
+        idx: a (seed, epoch, batch, slot, speaker index) key from SpeakerPoolBatchSampler
+        """
+        rng = counter_rng(idx)
+        utts = self.speaker_dict[self.speakers[idx[-1]]]
+        utt = rng.choice(utts)
+        regi = rng.choice(utts)
+        while regi == utt:
+            regi = rng.choice(utts)
+        utt_audio = torchaudio.load(utt)[0].squeeze(0)  # [T]
+        regi_audio = torchaudio.load(regi)[0].squeeze(0)
+        regi_audio = truc_wav(
+            regi_audio,
+            length=self.regi_length if self.regi_length is not None else self.mix_length,
+            rng=rng,
+        )
+        utt_audio = truc_wav(utt_audio, length=self.mix_length, rng=rng)
+        return utt_audio, regi_audio
+
+
+class SpeakerPoolBatchSampler(Sampler):
+    def __init__(
+        self,
+        dataset: TargetDMPoolDataset,
+        batch_size,
+        rank,
+        world_size,
+        mix_factor=2,
+        seed=1234,
+    ):
+        """
+        Batch sampler for TargetDMPoolDataset.
+        Each batch is a pool of batch_size // mix_factor distinct speakers, which is turned into
+        batch_size mixtures by MultiplexCollate, so only 2 / mix_factor files are read per mixture.
+
+        Args:
+            dataset: the TargetDMPoolDataset
+            batch_size: the number of mixtures per batch on this rank
+            mix_factor: how many mixtures are formed from each loaded pool item
+            seed: the sampling seed, offset by rank
+        """
+        self.pool_size = batch_size // mix_factor
+        assert (
+            self.pool_size > mix_factor
+        ), f"pool size {self.pool_size} should be larger than mix_factor {mix_factor} to avoid repeated pairs"
+        assert self.pool_size <= len(
+            dataset.speakers
+        ), "pool size is larger than the number of speakers"
+        self.mix_factor = mix_factor
+        self.batch_size = self.pool_size * mix_factor
+        self.num_speakers = len(dataset.speakers)
+        self.num_batches = math.ceil(len(dataset) / world_size / self.batch_size)
+        self.seed = seed + rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def seek(self, num_batches):
+        """
+        Skip the first num_batches batches of the current epoch.
+        """
+        self.start = num_batches
+
+    def __iter__(self):
+        ## every batch is a pure function of (seed, epoch, batch)
+        for b in range(self.start, self.num_batches):
+            key = (self.seed, self.epoch, b)
+            speakers = counter_rng(key).sample(range(self.num_speakers), self.pool_size)
+            yield [key + (slot, spk) for slot, spk in enumerate(speakers)]
+
+    def __len__(self):
+        return self.num_batches
+
+
+class MultiplexCollate:
+    def __init__(self, mix_factor=2):
+        """
+        Collate function for TargetDMPoolDataset.
+        The i-th pool item is used as the target of mix_factor mixtures, with the pool items
+        (i + 1), ..., (i + mix_factor) mod P as interferers. The offsets are distinct and smaller
+        than the pool size P, so no (target, interferer) pair repeats and no speaker interferes with itself.
+
+        Returns the raw (spk1, spk2, regi) crops of shape [P * mix_factor, T] for DynamicMixer.
+        """
+        self.mix_factor = mix_factor
+
+    def __call__(self, batch):
+        utt, regi = zip(*batch)
+        utt, regi = torch.stack(utt), torch.stack(regi)
+        pool_size = utt.size(0)
+        assert pool_size > self.mix_factor
+        target = torch.arange(pool_size).repeat(self.mix_factor)  # [P * M]
+        offset = torch.arange(1, self.mix_factor + 1).repeat_interleave(pool_size)
+        interferer = (target + offset) % pool_size
+        return utt[target], utt[interferer], regi[target]
+
+
 class TargetDataset(Dataset):
     def __init__(
         self,
@@ -100,19 +362,35 @@ class TargetDataset(Dataset):
         rank: int,
         mix_length=48080,
         regi_length=64080,
+        seed=None,
     ):
         """
         The regular dataset for target speaker extraction.
         Has to provide three .scp files that have mix_path, regi_path, clean_path aligned
+
+        Arguments:
+            seed: if not None, the crop of example idx only depends on (seed, idx),
+                so the crops are the same every epoch, e.g. for a comparable dev set
         """
         self.mix_list = get_source_list(mix_path)
         self.regi_list = get_source_list(regi_path)
         self.clean_list = get_source_list(clean_path)
+        self.mix_path = mix_path
         self.mix_length = mix_length
         self.regi_length = regi_length
         self.rank = rank
+        self.seed = seed
+        self.lengths = None
         pass
 
+    def get_lengths(self):
+        """
+        Return the number of samples of each mixture from the scp metadata
+        """
+        if self.lengths is None:
+            self.lengths = get_source_lengths(self.mix_path)
+        return self.lengths
+
     def __len__(self):
         return len(self.mix_list)
 
@@ -123,8 +401,182 @@ class TargetDataset(Dataset):
         mix_audio = torchaudio.load(mix_path)[0].squeeze(0)  # [T]
         regi_audio = torchaudio.load(regi_path)[0].squeeze(0)
         clean_audio = torchaudio.load(clean_path)[0].squeeze(0)
+        rng = counter_rng((self.seed, idx)) if self.seed is not None else None
         mix_audio, clean_audio = truc_wav(
-            mix_audio, clean_audio, length=self.mix_length
+            mix_audio, clean_audio, length=self.mix_length, rng=rng
         )
-        regi_audio = truc_wav(regi_audio, length=self.regi_length)
+        regi_audio = truc_wav(regi_audio, length=self.regi_length, rng=rng)
         return mix_audio, clean_audio, regi_audio, mix_path, clean_path, regi_path
+
+
+def collate_pad(batch):
+    """
+    Collate function for TargetDataset with full-length audio (mix_length=None).
+    Pads the audio of the batch to the longest one with zeros.
+
+    Returns:
+        mix [B, T], clean [B, T], regi [B, T'], lengths [B], regi_lengths [B], and the lists of mix, clean and regi paths
+    """
+    mix, clean, regi, mix_path, clean_path, regi_path = zip(*batch)
+    lengths = torch.tensor([m.size(0) for m in mix], dtype=torch.long)
+    regi_lengths = torch.tensor([r.size(0) for r in regi], dtype=torch.long)
+
+    def _pad(audio, length):
+        return torch.stack([F.pad(a, (0, length - a.size(0))) for a in audio])
+
+    return (
+        _pad(mix, int(lengths.max())),
+        _pad(clean, int(lengths.max())),
+        _pad(regi, int(regi_lengths.max())),
+        lengths,
+        regi_lengths,
+        list(mix_path),
+        list(clean_path),
+        list(regi_path),
+    )
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, max_samples=None, shuffle=False, seed=1234):
+        """
+        Batch sampler that groups utterances of similar length to reduce padding.
+        The utterances are sorted by length and cut into consecutive batches.
+
+        Args:
+            lengths: the number of samples of each utterance, e.g. TargetDataset.get_lengths()
+            batch_size: the maximum number of utterances per batch
+            max_samples: if given, also limit the padded size (batch size x longest length) of a batch
+            shuffle: whether to shuffle the order of the batches
+            seed: the seed to shuffle the batches
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        self.batches = []
+        batch = []
+        for i in order:
+            if len(batch) > 0 and (
+                len(batch) == batch_size
+                or (
+                    max_samples is not None
+                    and lengths[i] * (len(batch) + 1) > max_samples
+                )
+            ):
+                self.batches.append(batch)
+                batch = []
+            batch.append(i)
+        if len(batch) > 0:
+            self.batches.append(batch)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = self.batches
+        if self.shuffle:
+            batches = list(batches)
+            random.Random(f"{self.seed}_{self.epoch}").shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class ShardSampler(Sampler):
+    def __init__(self, dataset, rank, world_size):
+        """
+        Split a dataset across ranks for evaluation.
+        Unlike DistributedSampler, no examples are repeated to even out the shards, so the shard sizes
+        may differ by one and the results have to be weighted by the number of examples.
+        """
+        self.indices = list(range(rank, len(dataset), world_size))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+## the fields of a token cache, in the order of the model inputs (mix, clean, regi)
+TOKEN_CACHE_FIELDS = ("mix", "clean", "regi")
+
+
+def load_token_cache_meta(cache_dir):
+    """
+    Return the meta of a complete token cache, None if there is none.
+    The meta is written last, so a partially written cache has no meta.
+    """
+    meta_path = op.join(cache_dir, "meta.json")
+    if not op.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+class TokenCacheWriter:
+    def __init__(self, cache_dir, num):
+        """
+        Write the tokenized (mix, clean, regi) of num examples into memory mapped .npy files of cache_dir.
+        The tokens are stored as int16 and the continuous ssl features as float16.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_path = op.join(cache_dir, "meta.json")
+        if op.exists(meta_path):
+            ## invalidate the old cache first
+            os.remove(meta_path)
+        self.cache_dir = cache_dir
+        self.num = num
+        self.arrays = None
+        self.start = 0
+
+    def write(self, *tensors):
+        if self.arrays is None:
+            self.arrays = [
+                np.lib.format.open_memmap(
+                    op.join(self.cache_dir, f"{name}.npy"),
+                    mode="w+",
+                    dtype=np.float16 if t.is_floating_point() else np.int16,
+                    shape=(self.num,) + tuple(t.shape[1:]),
+                )
+                for name, t in zip(TOKEN_CACHE_FIELDS, tensors)
+            ]
+        end = self.start + len(tensors[0])
+        for array, t in zip(self.arrays, tensors):
+            array[self.start : end] = t.cpu().numpy().astype(array.dtype)
+        self.start = end
+
+    def close(self, meta: dict):
+        assert self.start == self.num, f"{self.start} of {self.num} examples written"
+        for array in self.arrays or []:
+            array.flush()
+        with open(op.join(self.cache_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+
+class CachedTokenDataset(Dataset):
+    def __init__(self, cache_dir):
+        """
+        The tokenized (mix, clean, regi) written by TokenCacheWriter, to be passed to the model with tokenized=True.
+        The .npy files are memory mapped on first access, so that every data loader worker maps them on its own.
+        """
+        self.cache_dir = cache_dir
+        self.num = load_token_cache_meta(cache_dir)["num"]
+        self.arrays = None
+
+    def __len__(self):
+        return self.num
+
+    def __getitem__(self, idx):
+        if self.arrays is None:
+            self.arrays = [
+                np.load(op.join(self.cache_dir, f"{name}.npy"), mmap_mode="r")
+                for name in TOKEN_CACHE_FIELDS
+            ]
+        res = []
+        for array in self.arrays:
+            t = torch.from_numpy(np.array(array[idx]))
+            res.append(t.float() if t.is_floating_point() else t.long())
+        return tuple(res)
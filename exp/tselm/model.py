@@ -4,8 +4,118 @@ import torch.nn as nn
 import torch
 import torch.nn.functional as F
 import copy
+import contextlib
+import hashlib
 
 from utils.wav import truc_wav, split_audio
+from models.modules.checkpoint import checkpoint_layers
+
+
+## the frozen pretrained models, which are not part of the module tree
+FROZEN_MODULES = ("hifi_gan", "discrete_ssl")
+
+
+class Tokenizer:
+    def __init__(
+        self,
+        discrete_ssl: nn.Module,
+        ssl_layers: List[int],
+        mix_continuous=False,
+        concat_regi=True,
+        ssl_precision=None,
+    ):
+        """
+        The frozen part of the model, which turns the audio into the inputs of the trainable part.
+        It is kept apart from Model so that it can be sent to other processes, see exp.tselm.pipeline.
+        """
+        self.discrete_ssl = discrete_ssl
+        self.ssl_layers = ssl_layers
+        self.mix_continuous = mix_continuous
+        self.concat_regi = concat_regi
+        self.ssl_precision = ssl_precision
+
+    def _ssl_autocast(self, device):
+        """
+        The autocast context of the frozen ssl model
+        """
+        if self.ssl_precision is None:
+            return contextlib.nullcontext()
+        dtype = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[
+            self.ssl_precision
+        ]
+        return torch.autocast(device.type, dtype=dtype, enabled=dtype is not None)
+
+    @torch.no_grad()
+    def sig_to_toks(self, audio):
+        """
+        Discretize audio to tokens
+        
+        Arguments
+        ---------
+        audio: torch.Tensor
+            shape: [B, T]
+        
+        Return
+        ------
+        toks: torch.Tensor
+            shape: [B, N, K] where N is the time dimension and K is the number of layers 
+            
+        """
+        with self._ssl_autocast(audio.device):
+            toks, _, _ = self.discrete_ssl(audio, SSL_layers=self.ssl_layers)
+        return toks  # [B, N, K]
+
+    @torch.no_grad()
+    def ssl_feats(self, audio, start=200, length=150):
+        """
+        Get the features of the continuous ssl model
+
+        Args:
+            audio: [B, T]
+            start: the start of the features to keep
+            length: the length of the features
+        Return:
+            feats: [B, N, K, H], where the N is the middle length after concatenation with register audio
+        """
+        with self._ssl_autocast(audio.device):
+            in_embs: torch.Tensor = self.discrete_ssl.ssl_model(audio)[
+                self.ssl_layers
+            ]  # [K,B,N,H]
+        ## the ssl model may run in lower precision than the trainable part
+        in_embs = in_embs.float().movedim(0, -2)  # [B,N,K,H]
+        return in_embs[:, start : start + length]
+
+    @torch.no_grad()
+    def __call__(self, mix, clean, regi, with_regi=True):
+        """
+        Args:
+            mix: mix audio [B,T]
+            clean: clean audio [B,T], or None
+            regi: reference audio [B,T]
+            with_regi: whether to tokenize the reference, e.g. not if it is enrolled already
+        Returns:
+            mix_in: the mix tokens [B,N,K], or the ssl features [B,N,K,H] if mix_continuous
+            true_toks: the clean tokens [B,N,K], None if clean is None
+            regi_toks: the reference tokens [B,N',K], None if not with_regi
+        """
+        if self.concat_regi:
+            mix_audio = torch.cat([regi, mix, regi], dim=1)  # [B, T]
+            assert mix_audio.size(1) == 176240  ##
+            if self.mix_continuous is False:
+                mix_in = self.sig_to_toks(mix_audio)  # [B,N,K]
+                mix_in = mix_in[:, 200 : 200 + 150, :].contiguous()  # [B, N, K]
+            else:
+                mix_in = self.ssl_feats(mix_audio, 200, 150)
+        else:
+            mix_audio = mix
+            assert mix_audio.size(1) == 48080
+            if self.mix_continuous is False:
+                mix_in = self.sig_to_toks(mix_audio).contiguous()  # [B,N,K]
+            else:
+                mix_in = self.ssl_feats(mix_audio, 0, 150)
+        true_toks = None if clean is None else self.sig_to_toks(clean)  # [B, N, K]
+        regi_toks = self.sig_to_toks(regi) if with_regi else None  # [B, N, K]
+        return mix_in, true_toks, regi_toks
 
 
 class Model(nn.Module):
@@ -24,6 +134,8 @@ class Model(nn.Module):
         vocab_size: int,
         mix_continuous=False,
         concat_regi=True,
+        ssl_precision=None,
+        lm_checkpointing=False,
     ):
         """
         The model class for TSELM based models
@@ -31,11 +143,18 @@ class Model(nn.Module):
         Arguments:
             mix_continuous: Whether to keep the mix continuous with tokenization
             concat_regi: Whether to concat reference audio to mixture
+            ssl_precision: The precision [fp32, bf16, fp16] to run the frozen ssl model in.
+                If None, the same as the trainable part (the autocast of the trainer)
+            lm_checkpointing: Activation checkpointing of the conformer layers of the lm,
+                True for all the layers or a list of layer indices
 
         """
         super().__init__()
-        self.hifi_gan = hifi_gan
-        self.discrete_ssl = discrete_ssl
+        ## The frozen models are kept out of the module tree so that DDP and the
+        ## state dict only see the trainable parameters. They still follow .to() and .train()
+        self.__dict__["hifi_gan"] = hifi_gan
+        self.__dict__["discrete_ssl"] = discrete_ssl
+        self._frozen_fingerprint = None
         self.ssl_layers = ssl_layers
         self.attention_mlp = attention_mlp
         self.embedding = embedding
@@ -49,25 +168,74 @@ class Model(nn.Module):
         self.fusion = fusion
         self.film = film
         self.fusion_norm = fusion_norm
+        self.ssl_precision = ssl_precision
+        self.lm_checkpointed_layers = checkpoint_layers(
+            self.lm.encoder.layers, lm_checkpointing
+        )
+        self.tokenizer = Tokenizer(
+            discrete_ssl, ssl_layers, mix_continuous, concat_regi, ssl_precision
+        )
+
+    def frozen_modules(self):
+        return [getattr(self, name) for name in FROZEN_MODULES]
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        for module in self.frozen_modules():
+            module._apply(fn, *args, **kwargs)
+        return self
+
+    def train(self, mode=True):
+        super().train(mode)
+        for module in self.frozen_modules():
+            module.train(mode)
+        return self
+
+    def filter_frozen(self, state_dict):
+        """
+        Drop the weights of the frozen models, which older checkpoints still have
+        """
+        return {
+            k: v
+            for k, v in state_dict.items()
+            if k.split(".")[0] not in FROZEN_MODULES
+        }
+
+    def load_state_dict(self, state_dict, strict=True, **kwargs):
+        return super().load_state_dict(
+            self.filter_frozen(state_dict), strict=strict, **kwargs
+        )
+
+    def frozen_fingerprint(self):
+        """
+        The sha1 of the weights of the frozen models and the k-means centroids.
+        It is saved in the checkpoints, which only have the trainable parameters,
+        to check that the same frozen models are attached when loading.
+        """
+        if self._frozen_fingerprint is None:
+            h = hashlib.sha1()
+            for name, module in zip(FROZEN_MODULES, self.frozen_modules()):
+                for k, v in module.state_dict().items():
+                    h.update(f"{name}.{k}".encode())
+                    h.update(v.detach().float().cpu().numpy().tobytes())
+            for vocabulary in self.discrete_ssl.vocabularies:
+                h.update(vocabulary.tobytes())
+            self._frozen_fingerprint = h.hexdigest()
+        return self._frozen_fingerprint
+
+    def check_frozen(self, fingerprint):
+        """
+        Return whether the attached frozen models match the fingerprint of a checkpoint.
+        Checkpoints without fingerprint are considered matching.
+        """
+        return fingerprint is None or fingerprint == self.frozen_fingerprint()
 
     @torch.no_grad()
     def sig_to_toks(self, audio):
         """
-        Discretize audio to tokens
-        
-        Arguments
-        ---------
-        audio: torch.Tensor
-            shape: [B, T]
-        
-        Return
-        ------
-        toks: torch.Tensor
-            shape: [B, N, K] where N is the time dimension and K is the number of layers 
-            
+        Discretize audio [B, T] to tokens [B, N, K], see Tokenizer.sig_to_toks
         """
-        toks, _, _ = self.discrete_ssl(audio, SSL_layers=self.ssl_layers)
-        return toks  # [B, N, K]
+        return self.tokenizer.sig_to_toks(audio)
 
     @torch.no_grad()
     def toks_to_sig(self, toks):
@@ -142,6 +310,11 @@ class Model(nn.Module):
         in_embs = torch.matmul(att_w.transpose(2, -1), in_embs).squeeze(-2)  # [B, N, H]
         return in_embs
 
+    def _emb_feats(self, in_embs, attention_mlp):
+        att_w = attention_mlp(in_embs)  # [B,N,K,1]
+        in_embs = torch.matmul(att_w.transpose(2, -1), in_embs).squeeze(-2)  # [B, N, H]
+        return in_embs
+
     def _emb_ssl(self, audio, attention_mlp, start=200, length=150):
         """
         Get the embedding of the continuous ssl model
@@ -154,27 +327,26 @@ class Model(nn.Module):
         Return:
             emb: [B, N, K], where the N is the middle length after concatenation with register audio
         """
-        with torch.no_grad():
-            in_embs: torch.Tensor = self.discrete_ssl.ssl_model(audio)[
-                self.ssl_layers
-            ]  # [K,B,N,H]
-        in_embs = in_embs.movedim(0, -2)  # [B,N,K,H]
-        in_embs = in_embs[:, start : start + length]
-        att_w = attention_mlp(in_embs)  # [B,N,K,1]
-        in_embs = torch.matmul(att_w.transpose(2, -1), in_embs).squeeze(-2)  # [B, N, H]
-        return in_embs
+        return self._emb_feats(
+            self.tokenizer.ssl_feats(audio, start, length), attention_mlp
+        )
 
-    def inference(self, mix, regi):
+    def inference(self, mix, regi, enrollment=None):
         """
         mix: [1,T] torch audio 2d
         regi: [1,T] torch audio 2d used as register audio
+        enrollment: the enrollment of regi from enroll, e.g. cached for the speaker, regi is not used if given
         """
         mix_array = split_audio(mix.squeeze(0), 48080)  # [T]
-        regi = truc_wav(regi.squeeze(0), length=64080).unsqueeze(0)  # [1,T]
+        if enrollment is None:
+            ## the reference is tokenized and projected once for all the chunks
+            enrollment = self.enroll(regi)
         aux_list = []
         for audio in mix_array:
             audio = audio.unsqueeze(0)  # [1,T]
-            out_toks = self.forward(audio, None, regi, inference=True)  # [B,N,K]
+            out_toks = self.forward(
+                audio, None, None, inference=True, enrollment=enrollment
+            )  # [B,N,K]
             aux = self.recon(out_toks)  # [1, T]
             aux_list.append(aux)
         recon = torch.cat(aux_list, dim=1)  # [1, T']
@@ -182,42 +354,124 @@ class Model(nn.Module):
         recon = recon[:, :length]
         return recon, int(length)
 
-    def forward(self, mix, clean, regi, inference=False):
+    def inference_batch(self, mix, regi, lengths, regi_lengths, chunk_batch=None):
+        """
+        Batched version of inference for padded audio, e.g. from dataset.collate_pad.
+        Every mixture is split into chunks of 48080 samples, and the chunks of all the mixtures
+        are run together, skipping the chunks that only have padding.
+
+        Args:
+            mix: [B, T] padded mixtures
+            regi: [B, T'] padded reference audio
+            lengths: [B] the lengths of the mixtures
+            regi_lengths: [B] the lengths of the reference audio
+            chunk_batch: the maximum number of chunks to run at once, all at once if None
+        Returns:
+            a list of B reconstructed audio of shape [1, T_i]
+        """
+        chunk = 48080
+        bsz = mix.size(0)
+        num_chunks = (mix.size(1) + chunk - 1) // chunk
+        mix = F.pad(mix, (0, num_chunks * chunk - mix.size(1)))
+        chunks = mix.view(bsz * num_chunks, chunk)  # [B*C, T]
+        enrollment = self.enroll(regi, regi_lengths)
+        starts = torch.arange(num_chunks, device=lengths.device) * chunk
+        valid = (starts.unsqueeze(0) < lengths.unsqueeze(1)).flatten()  # [B*C]
+        idxes = valid.nonzero().squeeze(1).to(mix.device)
+        step = len(idxes) if chunk_batch is None else chunk_batch
+        aux_list = []
+        for start in range(0, len(idxes), step):
+            idx = idxes[start : start + step]
+            out_toks = self.forward(
+                chunks[idx],
+                None,
+                None,
+                inference=True,
+                enrollment=self.select_enrollment(enrollment, idx // num_chunks),
+            )  # [b,N,K]
+            aux_list.append(self.recon(out_toks))  # [b, T]
+        aux = torch.cat(aux_list, dim=0)
+        recon = aux.new_zeros(bsz * num_chunks, aux.size(1))
+        recon[idxes] = aux
+        recon = recon.view(bsz, -1)  # [B, T']
+        return [
+            recon[i : i + 1, : min(int(lengths[i]), recon.size(1))] for i in range(bsz)
+        ]
+
+    def tokenize(self, mix, clean, regi, with_regi=True):
+        """
+        Run the frozen ssl model, everything of forward that does not depend on the trainable parameters.
+        The outputs can be cached and passed to forward with tokenized=True, see Tokenizer.__call__
+        """
+        return self.tokenizer(mix, clean, regi, with_regi)
+
+    @torch.no_grad()
+    def enroll(self, regi, regi_lengths=None):
+        """
+        Compute the reference side once, to be reused for all the chunks of the speakers with forward(enrollment=...).
+        That is the reference tokens and the keys and values of every fusion layer.
+
+        Args:
+            regi: reference audio [B,T], cut or padded to 64080 samples
+            regi_lengths: [B] the lengths of padded reference audio, if any
+        Returns:
+            the enrollment {"regi": the reference audio [B, 64080], "kv": the keys and values of the fusion layers}
+        """
+        if regi_lengths is None:
+            regi_lengths = [r.size(0) for r in regi]
+        regi = torch.stack(
+            [truc_wav(r[: int(l)], length=64080) for r, l in zip(regi, regi_lengths)]
+        )  # [B, T']
+        regi_toks = self.sig_to_toks(regi)
+        regi_emb = self._emb(regi_toks, self.embedding_regi, self.attention_mlp_regi)
+        return {"regi": regi, "kv": self.fusion.project_kv(regi_emb)}
+
+    def select_enrollment(self, enrollment, idx):
+        """
+        The enrollment of the speakers idx, e.g. the speaker of each chunk
+        """
+        return {
+            "regi": enrollment["regi"][idx],
+            "kv": [(k[idx], v[idx]) for k, v in enrollment["kv"]],
+        }
+
+    def forward(
+        self, mix, clean, regi, inference=False, tokenized=False, enrollment=None
+    ):
         """
         Args:
             mix: mix audio [B,T]
             clean1: clean 1 audio [B,T]
             regi: reference audio [B,T]
             inference: boolean standing for if inference 
+            tokenized: if True, mix, clean and regi are the outputs of tokenize instead of audio
+            enrollment: the reference from enroll, regi is not used if given
         Returns:
             if inference is False, return (loss, out_toks [B,N,K], true_toks [B, N,K], and error)
             else: return the out_toks [B,N,K]
         """
-        if self.concat_regi:
-            mix_audio = torch.cat([regi, mix, regi], dim=1)  # [B, T]
-            assert mix_audio.size(1) == 176240  ##
-            if self.mix_continuous is False:
-                mix_toks = self.sig_to_toks(mix_audio)  # [B,N,K]
-                mix_toks = mix_toks[:, 200 : 200 + 150, :].contiguous()  # [B, N, K]
-                mix_embs = self._emb(
-                    mix_toks, self.embedding, self.attention_mlp
-                )  # [B, N, H]
-            else:
-                mix_embs = self._emb_ssl(mix_audio, self.attention_mlp, 200, 150)
+        if enrollment is not None:
+            regi = enrollment["regi"]
+        if tokenized:
+            mix_in, true_toks, regi_toks = mix, clean, regi
         else:
-            mix_audio = mix
-            assert mix_audio.size(1) == 48080
-            if self.mix_continuous is False:
-                mix_toks = self.sig_to_toks(mix_audio)  # [B,N,K]
-                mix_toks = mix_toks.contiguous()  # [B, N, K]
-                mix_embs = self._emb(
-                    mix_toks, self.embedding, self.attention_mlp
-                )  # [B, N, H]
-            else:
-                mix_embs = self._emb_ssl(mix_audio, self.attention_mlp, 0, 150)
-        regi_toks = self.sig_to_toks(regi)  # [B, N, K]
-        regi_emb = self._emb(regi_toks, self.embedding_regi, self.attention_mlp_regi)
-        aux = self.fusion(mix_embs, regi_emb)[0]
+            mix_in, true_toks, regi_toks = self.tokenize(
+                mix, None if inference else clean, regi, enrollment is None
+            )
+        if self.mix_continuous is False:
+            mix_embs = self._emb(
+                mix_in, self.embedding, self.attention_mlp
+            )  # [B, N, H]
+        else:
+            mix_embs = self._emb_feats(mix_in, self.attention_mlp)
+        if enrollment is None:
+            regi_emb = self._emb(
+                regi_toks, self.embedding_regi, self.attention_mlp_regi
+            )
+            aux = self.fusion(mix_embs, regi_emb)[0]
+        else:
+            ## only the mixture side of the fusion runs
+            aux = self.fusion(mix_embs, None, kv=enrollment["kv"])[0]
         aux = self.film(mix_embs, aux)
         aux = self.fusion_norm(aux.transpose(1, 2)).transpose(1, 2)
         hyp_embs, _ = self.lm(aux, None)  # [B, N, H]
@@ -230,7 +484,6 @@ class Model(nn.Module):
         out_toks = torch.argmax(probs, dim=3)  # [B, N, K]
         if not inference:
             ## training
-            true_toks = self.sig_to_toks(clean)  # [B, N, K]
             loss = F.cross_entropy(probs.flatten(end_dim=-2), true_toks.flatten())
             return (loss, out_toks, true_toks, self._error(out_toks, true_toks))
         else:
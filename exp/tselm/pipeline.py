@@ -0,0 +1,152 @@
+### Tokenize the training batches in separate processes ahead of the trainer
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+
+def _tokenize_worker(tokenizer, device, amp_dtype, mixer_fn, in_queue, out_queue):
+    """
+    Take (index, data, mix_key) from in_queue and put (index, tokens, None) to out_queue until None is received.
+    data is the raw batch of the data loader, which is mixed first if there is a mixer.
+    On an error, (index, None, traceback) is put instead and the worker exits, index is None
+    if it failed before taking a batch.
+    """
+    idx = None
+    try:
+        device = torch.device(device)
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        mixer = mixer_fn() if mixer_fn is not None else None
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            idx, data, mix_key = item
+            data = [d.to(device, non_blocking=True) for d in data]
+            if mixer is not None:
+                data = mixer(*data, step=mix_key)
+            with torch.autocast(
+                device.type, dtype=amp_dtype, enabled=amp_dtype is not None
+            ):
+                toks = tokenizer(*data)
+            ## back through shared memory, the trainer copies them to its device
+            out_queue.put((idx, [t.cpu() for t in toks], None))
+            del data, toks
+    except Exception:
+        ## the traceback as text, the exception itself may not pickle
+        out_queue.put((idx, None, traceback.format_exc()))
+
+
+class TokenizerPipeline:
+    def __init__(
+        self,
+        tokenizer,
+        device,
+        amp_dtype=None,
+        mixer_fn=None,
+        num_workers=1,
+        prefetch=2,
+        poll_interval=10.0,
+    ):
+        """
+        Run the frozen tokenizer (see exp.tselm.model.Tokenizer) in num_workers processes on the same device,
+        so that tokenizing the next batches overlaps with the backward and the optimizer step of the trainer.
+        The raw batches and the tokens go through shared memory queues, with up to prefetch batches in flight.
+
+        Args:
+            tokenizer: the Tokenizer of the model, its weights are shared with the worker processes
+            device: the device to tokenize on
+            amp_dtype: the autocast dtype of the trainer, None for fp32
+            mixer_fn: builds the DynamicMixer to mix the raw sources with before tokenizing, if any.
+                The mixer is reseeded every micro-batch, so it does not matter which worker mixes a batch
+            poll_interval: the seconds to wait for the tokens before checking that the workers are alive.
+                An error in a worker or a dead worker is raised in iterate instead of waiting forever
+        """
+        ctx = mp.get_context("spawn")
+        self.in_queue = ctx.Queue()
+        self.out_queue = ctx.Queue()
+        self.prefetch = max(prefetch, 1)
+        self.poll_interval = poll_interval
+        self.workers = [
+            ctx.Process(
+                target=_tokenize_worker,
+                args=(
+                    tokenizer,
+                    str(device),
+                    amp_dtype,
+                    mixer_fn,
+                    self.in_queue,
+                    self.out_queue,
+                ),
+                daemon=True,
+            )
+            for _ in range(num_workers)
+        ]
+        for w in self.workers:
+            w.start()
+
+    def _get(self):
+        """
+        The next (index, tokens) of out_queue, raising the errors of the workers
+        """
+        while True:
+            try:
+                idx, toks, error = self.out_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead = [w for w in self.workers if not w.is_alive()]
+                if dead:
+                    raise RuntimeError(
+                        "tokenizer workers died: "
+                        + ", ".join(f"pid {w.pid} exit code {w.exitcode}" for w in dead)
+                    )
+                continue
+            if error is not None:
+                raise RuntimeError(
+                    f"tokenizer worker failed on batch {idx}:\n{error}"
+                )
+            return idx, toks
+
+    def iterate(self, loader, step=0, accum_steps=1):
+        """
+        Yield the tokens of the batches of loader in order.
+        step is the optimizer step of the first batch, which starts a window of accum_steps micro-batches.
+        Micro-batch i is mixed with the key step * accum_steps + i, the same as Trainer._mix_key
+        """
+        it = iter(loader)
+        sent = 0
+        done = False
+        pending = {}
+
+        def submit():
+            nonlocal sent, done
+            try:
+                data = next(it)
+            except StopIteration:
+                done = True
+                return
+            self.in_queue.put((sent, list(data), step * accum_steps + sent))
+            sent += 1
+
+        for _ in range(self.prefetch):
+            submit()
+        received = 0
+        while received < sent:
+            ## the workers may finish out of order
+            while received not in pending:
+                idx, toks = self._get()
+                pending[idx] = toks
+            toks = pending.pop(received)
+            received += 1
+            if not done:
+                submit()
+            yield toks
+
+    def close(self):
+        for _ in self.workers:
+            self.in_queue.put(None)
+        for w in self.workers:
+            w.join(timeout=10)
+            if w.is_alive():
+                ## e.g. stuck after an error of another worker
+                w.terminate()
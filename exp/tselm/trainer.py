@@ -1,5 +1,11 @@
 from trainer.abs_trainer import AbsTrainer
 import os.path as op
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from functools import partial
+from dataset import TokenCacheWriter, CachedTokenDataset, load_token_cache_meta
+from .pipeline import TokenizerPipeline
 
 
 class Trainer(AbsTrainer):
@@ -27,6 +33,80 @@ class Trainer(AbsTrainer):
             logger,
         )
         print(f"using trainer at {op.abspath(__file__)}")
+        module = self.model.module
+        self._log(
+            f"activation checkpointing: fusion layers {getattr(module.fusion, 'checkpointed_layers', [])}, "
+            f"lm layers {module.lm_checkpointed_layers}"
+        )
+        ## tokenize the training batches in separate processes ahead of the training step
+        self.pipeline = None
+        if config.tokenizer_workers:
+            self.pipeline = TokenizerPipeline(
+                module.tokenizer,
+                self.device,
+                amp_dtype=self.amp_dtype,
+                mixer_fn=(
+                    partial(config.tr_mixer, seed=config.seed + rank, device=device)
+                    if config.tr_mixer is not None
+                    else None
+                ),
+                num_workers=config.tokenizer_workers,
+                prefetch=config.tokenizer_prefetch or 2,
+            )
+            self._log(f"tokenizing in {config.tokenizer_workers} processes")
+        ## evaluate on the cached tokens of the dev set, which skips the frozen ssl model
+        self.cv_tokenized = False
+        if config.cv_token_cache is not None:
+            self.cv_data = self._cache_cv_data(self.cv_data, config.cv_token_cache)
+            self.cv_tokenized = True
+
+    def _token_cache_meta(self, cv_data):
+        """
+        Everything the cached tokens depend on, the cache is rebuilt if any of it changes
+        """
+        module = self.model.module
+        dataset = cv_data.dataset
+        return {
+            "frozen_fingerprint": module.frozen_fingerprint(),
+            "mix_path": op.abspath(dataset.mix_path),
+            "seed": dataset.seed,
+            "mix_length": dataset.mix_length,
+            "regi_length": dataset.regi_length,
+            "ssl_layers": [int(l) for l in module.ssl_layers],
+            "mix_continuous": module.mix_continuous,
+            "concat_regi": module.concat_regi,
+            "ssl_precision": module.ssl_precision,
+            "precision": self.precision,
+            "num": len(cv_data.sampler),
+        }
+
+    def _cache_cv_data(self, cv_data, cache_dir):
+        """
+        Tokenize the shard of the dev set of this rank once and return a data loader of the cached tokens
+        """
+        assert (
+            cv_data.dataset.seed is not None
+        ), "the cv_dataset needs a seed to fix the crops of the cached tokens"
+        cache_dir = op.join(cache_dir, f"rank{self.rank}_of_{dist.get_world_size()}")
+        meta = self._token_cache_meta(cv_data)
+        if load_token_cache_meta(cache_dir) != meta:
+            print(f"rank {self.rank}: tokenizing the dev set into {cache_dir}")
+            writer = TokenCacheWriter(cache_dir, meta["num"])
+            self.model.eval()
+            with torch.no_grad():
+                for data in cv_data:
+                    mix, clean, regi = (d.to(self.device) for d in data[:3])
+                    with self._autocast():
+                        writer.write(*self.model.module.tokenize(mix, clean, regi))
+            writer.close(meta)
+        else:
+            self._log(f"using the cached dev set tokens of {cache_dir}")
+        return DataLoader(
+            CachedTokenDataset(cache_dir),
+            batch_size=cv_data.batch_size,
+            shuffle=False,
+            num_workers=cv_data.num_workers,
+        )
 
     def get_res(self, loss, error):
         res = {}
@@ -34,29 +114,70 @@ class Trainer(AbsTrainer):
         res["error"] = error
         return res
 
+    def train(self):
+        try:
+            super().train()
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.close()
+
+    def _train_data(self, tr_data, start_batch):
+        if self.pipeline is None:
+            return tr_data
+        ## the batches are tokens instead of audio
+        return self.pipeline.iterate(tr_data, self.step, self.accum_steps)
+
+    def _mix_key(self, batch):
+        """
+        The key to reseed the mixer with for the micro-batch batch of the epoch, unique for every micro-batch
+        of the run so that the micro-batches of a step are mixed differently, and the same after resuming
+        """
+        return self.step * self.accum_steps + batch % self.accum_steps
+
     def _train_one_batch(self, batch, data, optim, if_log) -> dict:
+        timer = self.timer
+        with timer.phase("h2d"):
+            ## the batches are in pinned memory on cuda
+            data = [d.to(self.device, non_blocking=True) for d in data]
+        if self.pipeline is not None:
+            with self._autocast(), timer.phase("forward"):
+                loss, _, _, error = self.model(*data, inference=False, tokenized=True)
+            with timer.phase("backward"):
+                self._backward(loss)
+            with timer.phase("optim"):
+                self._optim_step(optim)
+            if if_log:
+                return self.get_res(loss, error)
+            return None
+        if self.mixer is not None:
+            ## data is the raw (spk1, spk2, regi) crops, mix them on device
+            with timer.phase("mix"):
+                data = self.mixer(*data, step=self._mix_key(batch))
         mix, clean, regi = data
-        mix, clean, regi = (
-            mix.to(self.device),
-            clean.to(self.device),
-            regi.to(self.device),
-        )
-        loss, _, _, error = self.model(mix, clean, regi, inference=False)
-        loss.backward()
-
-        optim.step()
-        optim.zero_grad()
+        with self._autocast():
+            ## the frozen ssl model and the trainable part are timed separately
+            with timer.phase("tokenize"):
+                toks = self.model.module.tokenize(mix, clean, regi)
+            with timer.phase("forward"):
+                loss, _, _, error = self.model(*toks, inference=False, tokenized=True)
+        with timer.phase("backward"):
+            self._backward(loss)
+        with timer.phase("optim"):
+            self._optim_step(optim)
         if if_log:
             return self.get_res(loss, error)
         return None
 
     def _eval_one_batch(self, data) -> dict:
-        mix, clean, regi, _, _, _ = data
+        mix, clean, regi = data[:3]
         mix, clean, regi = (
             mix.to(self.device),
             clean.to(self.device),
             regi.to(self.device),
         )
-        loss, _, _, error = self.model(mix, clean, regi, inference=False)
+        with self._autocast():
+            loss, _, _, error = self.model(
+                mix, clean, regi, inference=False, tokenized=self.cv_tokenized
+            )
         res = self.get_res(loss, error)
         return res
@@ -1,18 +1,41 @@
 ## inference on libri2mix test set
 import argparse
 import tqdm
+from collections import OrderedDict
 import os.path as op
 import torch
 import torch.nn as nn
 import torch.multiprocessing as mp
 import torchaudio
-from torch.utils.data import random_split
+from torch.utils.data import random_split, DataLoader
 from hyperpyyaml import load_hyperpyyaml
-from dataset import TargetDataset
+from dataset import TargetDataset, BucketBatchSampler, collate_pad
+from utils.profiler import Profiler
+from trainer.helper import torch_load
+from exp.tselm.model import FROZEN_MODULES
 
 SEED = 1234
 
-def main(rank, args):
+
+def load_model_ckpt(ckpt_path):
+    """
+    Load the trainable weights and the frozen fingerprint of a checkpoint once, in shared memory,
+    so that the spawned processes get them without reading the file again.
+    The optimizer state and the weights of the frozen models are not kept.
+    """
+    ckpt = torch_load(ckpt_path)
+    state_dict = {
+        k: v.clone().share_memory_()
+        for k, v in ckpt["model_state_dict"].items()
+        if k.split(".")[0] not in FROZEN_MODULES
+    }
+    return {
+        "model_state_dict": state_dict,
+        "frozen_fingerprint": ckpt.get("frozen_fingerprint"),
+    }
+
+
+def main(rank, args, ckpt):
     device = args.gpus[rank % len(args.gpus)] # t
     world_size = args.proc
     torch.cuda.set_device(device)
@@ -23,6 +46,7 @@ def main(rank, args):
     dataset = TargetDataset(
         mix_scp, aux_s1_scp, s1_scp, -1, mix_length=None, regi_length=None
     )
+    lengths = dataset.get_lengths() if args.batch_size > 1 else None
     if world_size != 1:
         generator = torch.Generator().manual_seed(SEED)
         num_samples = len(dataset)
@@ -33,21 +57,86 @@ def main(rank, args):
             split_sizes[i] += 1
         splits = random_split(dataset, split_sizes, generator=generator)
         dataset = splits[rank]
+        if lengths is not None:
+            lengths = [lengths[i] for i in dataset.indices]
         print(f"rank {rank} get dataset of length {len(dataset)} on device {device}")
     with open(args.config_path, "r") as f:
         config = load_hyperpyyaml(f)
     model: nn.Module = config.get("model")
-    ckpt = torch.load(args.ckpt_path, map_location=device)
     model.cuda(device)
+    ## the frozen models are attached from the config, the checkpoint has the trainable part
     model.load_state_dict(ckpt["model_state_dict"], strict=False)
+    if not model.check_frozen(ckpt.get("frozen_fingerprint")):
+        print(
+            "WARNING! the frozen models differ from the ones the checkpoint was trained with"
+        )
+    profiler = None
+    if args.profile_dir is not None:
+        ## the profiler of the config if any, counting batches instead of training steps
+        profiler = config.get("profiler") or Profiler
+        profiler = profiler(
+            out_dir=args.profile_dir,
+            rank=rank,
+            name="inference",
+            steps=args.profile_steps,
+        )
+    if args.batch_size > 1:
+        ## batch utterances of similar length together
+        data = DataLoader(
+            dataset,
+            batch_sampler=BucketBatchSampler(lengths, args.batch_size),
+            collate_fn=collate_pad,
+            num_workers=2,
+        )
+        with torch.no_grad():
+            for i, (
+                mix,
+                _,
+                regi,
+                mix_lengths,
+                regi_lengths,
+                mix_paths,
+                _,
+                _,
+            ) in enumerate(tqdm.tqdm(data)):
+                if profiler is not None:
+                    profiler.step(i)
+                mix, regi = mix.to(device), regi.to(device)
+                outputs = model.inference_batch(
+                    mix, regi, mix_lengths, regi_lengths, chunk_batch=args.chunk_batch
+                )
+                for output, mix_path in zip(outputs, mix_paths):
+                    name = mix_path.split("/")[-1]
+                    torchaudio.save(op.join(args.output, name), output.cpu(), 16000)
+        if profiler is not None:
+            profiler.close()
+        print("done")
+        return
+    ## the enrollments of the last references, by path
+    enrollments = OrderedDict()
     with torch.no_grad():
-        for mix, _, regi, mix_path, _, _ in tqdm.tqdm(dataset):
+        for i, (mix, _, regi, mix_path, _, regi_path) in enumerate(
+            tqdm.tqdm(dataset)
+        ):
+            if profiler is not None:
+                profiler.step(i)
             mix, regi = mix.to(device), regi.cuda(device)
             mix, regi = mix.unsqueeze(0), regi.unsqueeze(0)  # [1, T]
-            output, _ = model.inference(mix, regi)  # [1,T]
+            enrollment = enrollments.get(regi_path)
+            if enrollment is None:
+                enrollment = model.enroll(regi)
+                if args.enroll_cache > 0:
+                    enrollments[regi_path] = enrollment
+                    if len(enrollments) > args.enroll_cache:
+                        enrollments.popitem(last=False)
+            else:
+                enrollments.move_to_end(regi_path)
+            output, _ = model.inference(mix, regi, enrollment=enrollment)  # [1,T]
             output = output.cpu()
             name = mix_path.split("/")[-1]
             torchaudio.save(op.join(args.output, name), output, 16000)
+    if profiler is not None:
+        profiler.close()
     print("done")
 
 
@@ -70,8 +159,41 @@ if __name__ == "__main__":
         type=int,
         default=8,
     )
+    parser.add_argument(
+        "-batch",
+        "--batch_size",
+        type=int,
+        default=1,
+        help="The number of utterances per batch, utterances of similar length are batched together.",
+    )
+    parser.add_argument(
+        "--chunk_batch",
+        type=int,
+        default=None,
+        help="The maximum number of 3s chunks to run at once when batching.",
+    )
+    parser.add_argument(
+        "--enroll_cache",
+        type=int,
+        default=128,
+        help="The number of references whose tokens and fusion keys and values are kept to reuse for the utterances with the same reference, 0 to disable.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="If given, capture torch.profiler traces into this folder, with the profiler settings of the config if any.",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        nargs="+",
+        type=int,
+        default=[0],
+        help="The batches to start a profiler capture at.",
+    )
     args = parser.parse_args()
+    ckpt = load_model_ckpt(args.ckpt_path)
     if args.proc != 1:
-        mp.spawn(main, args=(args,), nprocs=args.proc, join=True)
+        mp.spawn(main, args=(args, ckpt), nprocs=args.proc, join=True)
     else:
-        main(0, args)
+        main(0, args, ckpt)
@@ -229,7 +229,9 @@ class DiscreteSSL(nn.Module):
             ):
                 if layer_num not in SSL_layers:
                     continue
-                tokens = model.predict(feats[layer_num].flatten(end_dim=-2).cpu())
+                tokens = model.predict(
+                    feats[layer_num].flatten(end_dim=-2).float().cpu()
+                )
                 embs = vocabulary[tokens]
                 embeddings.append(
                     torch.tensor(
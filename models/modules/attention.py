@@ -14,6 +14,40 @@ import numpy as np
 from typing import Optional
 import torch.nn.functional as F
 import math
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+    """A dict that only keeps the size most recently used entries."""
+
+    def __init__(self, size=4):
+        super().__init__()
+        self.size = size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+def autocast_state(device_type):
+    """Whether autocast is enabled for device_type and its dtype, None if disabled."""
+    if hasattr(torch, "get_autocast_dtype"):
+        enabled = torch.is_autocast_enabled(device_type)
+        return enabled, torch.get_autocast_dtype(device_type) if enabled else None
+    ## torch < 2.4
+    if device_type == "cuda":
+        enabled = torch.is_autocast_enabled()
+        return enabled, torch.get_autocast_gpu_dtype() if enabled else None
+    enabled = torch.is_autocast_cpu_enabled()
+    return enabled, torch.get_autocast_cpu_dtype() if enabled else None
 
 
 def length_to_mask(length, max_len=None, dtype=None, device=None):
@@ -349,7 +383,10 @@ class KeyValueAttention(nn.Module):
 
 
 class RelPosEncXL(nn.Module):
-    """ """
+    """The bidirectional sinusoidal positional embedding of RelPosMHAXL.
+    The embeddings of the last few lengths are kept and the same tensor is returned for them,
+    which lets RelPosMHAXL cache its projection.
+    """
 
     def __init__(self, emb_dim):
         super().__init__()
@@ -360,6 +397,7 @@ class RelPosEncXL(nn.Module):
             * -(math.log(10000.0) / self.emb_dim)
         )
         self.register_buffer("inv_freq", inv_freq)
+        self._cache = LRUCache()
 
     def forward(self, x: torch.Tensor):
         """
@@ -372,6 +410,10 @@ class RelPosEncXL(nn.Module):
         pos_emb : torch.Tensor
         """
         seq_len = x.size(1)
+        cache_key = (seq_len, x.dtype, x.device)
+        pe = self._cache.get(cache_key)
+        if pe is not None:
+            return pe
         with torch.no_grad():
             tot_pe = torch.zeros((2, seq_len, self.emb_dim), dtype=x.dtype).to(x)
             pe_past = tot_pe[0]
@@ -391,6 +433,7 @@ class RelPosEncXL(nn.Module):
             pe_future = pe_future[1:].unsqueeze(0)
             pe = torch.cat([pe_past, pe_future], dim=1)
             # pe is now 1, 2*seq_len, embed_dim
+            self._cache.put(cache_key, pe)
             return pe
 
 
@@ -477,6 +520,8 @@ class RelPosMHAXL(nn.Module):
 
         self._reset_parameters()
         self.scale = 1 / math.sqrt(self.embed_dim)
+        ## the projections of the positional embeddings of the last few lengths without grad
+        self._pos_cache = LRUCache()
 
     def _reset_parameters(self):
         if self._qkv_same_embed_dim:
@@ -509,6 +554,70 @@ class RelPosMHAXL(nn.Module):
 
         return x[..., : pos_len // 2 + 1]
 
+    def rel_shift_view(self, x, klen):
+        """The same as rel_shift(x)[..., :klen] as a strided view of x, without padding and copying.
+        For x of shape (b, h, qlen, 2*S-1) with qlen <= S: out[..., i, j] = x[..., i, qlen - 1 + j - i].
+        The mask of mask_pos_future only covers columns beyond the first S, so it does not apply here.
+        """
+        x = x.contiguous()
+        b, h, qlen, pos_len = x.size()
+        return x.as_strided(
+            (b, h, qlen, klen),
+            (h * qlen * pos_len, qlen * pos_len, pos_len - 1, 1),
+            x.storage_offset() + qlen - 1,
+        )
+
+    def pos_proj(self, pos_embs):
+        """linear_pos(pos_embs) of shape (1, P, num_heads, head_dim).
+        Without grad, e.g. in evaluation, it is cached for the last few lengths and autocast dtypes
+        as long as pos_embs is the same tensor (see RelPosEncXL) and the weights are not updated.
+        """
+        if torch.is_grad_enabled():
+            return self.linear_pos(pos_embs).view(1, -1, self.num_heads, self.head_dim)
+        cache_key = (pos_embs.size(1), autocast_state(pos_embs.device.type))
+        version = (pos_embs._version, self.linear_pos.weight._version)
+        cached = self._pos_cache.get(cache_key)
+        if (
+            cached is not None
+            and cached[0] is pos_embs
+            and cached[1] == version
+            and cached[2].device == pos_embs.device
+        ):
+            return cached[2]
+        p_k = self.linear_pos(pos_embs).view(1, -1, self.num_heads, self.head_dim)
+        self._pos_cache.put(cache_key, (pos_embs, version, p_k))
+        return p_k
+
+    def _qk_weights(self):
+        """The query and key weights of qk_proj_weight, whose rows are [query, key] per head as in forward"""
+        weight = self.qk_proj_weight.view(self.num_heads, 2 * self.head_dim, -1)
+        return (
+            weight[:, : self.head_dim].reshape(self.embed_dim, -1),
+            weight[:, self.head_dim :].reshape(self.embed_dim, -1),
+        )
+
+    def project_kv(self, key, value):
+        """The keys and values of the heads (B, S, num_heads, head_dim) of a fixed key and value,
+        e.g. the reference, to be passed as kv to forward instead of projecting them every call.
+        """
+        bsz = key.shape[0]
+        if self._qkv_same_embed_dim:
+            _, kweight, vweight = self.in_proj_weight.chunk(3, dim=0)
+        else:
+            _, kweight = self._qk_weights()
+            vweight = self.v_proj_weight
+        key = nn.functional.linear(key, kweight).view(
+            bsz, -1, self.num_heads, self.head_dim
+        )
+        value = nn.functional.linear(value, vweight).view(
+            bsz, -1, self.num_heads, self.vhead_dim
+        )
+        if self.vbias is not None:
+            value = value + self.value_bias_weight.view(
+                1, 1, self.num_heads, self.vhead_dim
+            )
+        return key, value
+
     def forward(
         self,
         query,
@@ -518,6 +627,8 @@ class RelPosMHAXL(nn.Module):
         key_padding_mask=None,
         attn_mask=None,
         return_attn_weights=True,
+        self_attention=None,
+        kv=None,
     ):
         """
         Arguments
@@ -552,6 +663,15 @@ class RelPosMHAXL(nn.Module):
             be unchanged. If a BoolTensor is provided, positions with True is
             not allowed to attend while False values will be unchanged. If a
             FloatTensor is provided, it will be added to the attention weight.
+        return_attn_weights : bool
+            Whether to return the attention weights. If False, the attention
+            runs with scaled_dot_product_attention and the relative position
+            scores as its additive mask.
+        self_attention : bool
+            Whether query, key and value are the same tensor, which allows a
+            single input projection. If None, only the identity is checked.
+        kv : tuple
+            The keys and values from project_kv, used instead of key and value.
 
         Outputs
         -------
@@ -561,18 +681,30 @@ class RelPosMHAXL(nn.Module):
         attn_score : tensor
             (B, L, S) where B is the batch size, L is the target
             sequence length, S is the source sequence length.
+            Only if return_attn_weights.
         """
 
         # query, key and value are of shape batch, time, embed_dim
         bsz = query.shape[0]
-        klen = key.shape[1]
         qlen = query.shape[1]
 
-        if self._qkv_same_embed_dim:
+        if self_attention is None:
+            ## comparing the values would sync with the device
+            self_attention = query is key and key is value
+
+        if kv is not None:
+            if self._qkv_same_embed_dim:
+                qweight = self.in_proj_weight.chunk(3, dim=0)[0]
+            else:
+                qweight, _ = self._qk_weights()
+            query = nn.functional.linear(query, qweight).view(
+                bsz, -1, self.num_heads, self.head_dim
+            )
+            ## the same keys and values may be shared by the whole batch
+            key, value = (x.expand(bsz, -1, -1, -1) for x in kv)
+        elif self._qkv_same_embed_dim:
             # self-attention
-            if (query is key or torch.equal(query, key)) and (
-                key is value or torch.equal(key, value)
-            ):
+            if self_attention:
                 query, key, value = (
                     nn.functional.linear(query, self.in_proj_weight)
                     .view(bsz, -1, self.num_heads, self.head_dim * 3)
@@ -600,12 +732,13 @@ class RelPosMHAXL(nn.Module):
                 bsz, -1, self.num_heads, self.vhead_dim
             )
 
-        if self.vbias is not None:
+        if self.vbias is not None and kv is None:
             value = value + self.value_bias_weight.view(
                 1, 1, self.num_heads, self.vhead_dim
             )
+        klen = key.shape[1]
 
-        p_k = self.linear_pos(pos_embs).view(1, -1, self.num_heads, self.head_dim)
+        p_k = self.pos_proj(pos_embs)
         # (batch, head, klen, d_k)
 
         q_with_bias_u = (
@@ -616,6 +749,20 @@ class RelPosMHAXL(nn.Module):
             query + self.pos_bias_v.view(1, 1, self.num_heads, self.head_dim)
         ).transpose(1, 2)
 
+        if not return_attn_weights:
+            ## the scale is folded into the query, the shifted scores are the mask as they are
+            matrix_bd = torch.matmul(
+                q_with_bias_v * self.scale, p_k.permute(0, 2, 3, 1)
+            )
+            return self._sdpa_forward(
+                q_with_bias_u,
+                key,
+                value,
+                matrix_bd,
+                key_padding_mask,
+                attn_mask,
+            )
+
         # (batch, head, qlen, klen)
         matrix_ac = torch.matmul(q_with_bias_u, key.permute(0, 2, 3, 1))
         # (batch, num_heads, klen, 2*klen-1)
@@ -660,9 +807,52 @@ class RelPosMHAXL(nn.Module):
             return out, attn_score
         return out
 
+    def _sdpa_forward(
+        self, q_with_bias_u, key, value, matrix_bd, key_padding_mask, attn_mask
+    ):
+        """The attention without weights, with the shifted relative position scores as the additive mask
+        of scaled_dot_product_attention, which avoids materializing the content scores and the probabilities.
+        matrix_bd (batch, head, qlen, 2*klen-1), already scaled, is computed once and passed as a strided view
+        without copies if there are no masks. The boolean masks are combined and filled in a single copy.
+        """
+        bsz, _, qlen, _ = q_with_bias_u.size()
+        klen = key.size(1)
+        bias = self.rel_shift_view(matrix_bd, klen)
+        masked = None
+        if attn_mask is not None:
+            if attn_mask.ndim == 2:
+                attn_mask = attn_mask.view(1, 1, qlen, klen)
+            else:
+                attn_mask = attn_mask.view(-1, self.num_heads, qlen, klen)
+
+            if attn_mask.dtype == torch.bool:
+                masked = attn_mask
+            else:
+                bias = bias + attn_mask
+
+        if key_padding_mask is not None:
+            padding = key_padding_mask.bool().view(bsz, 1, 1, klen)
+            masked = padding if masked is None else masked | padding
+
+        if masked is not None:
+            bias = bias.masked_fill(masked, self.attn_fill_value)
+
+        x = F.scaled_dot_product_attention(
+            q_with_bias_u,
+            key.transpose(1, 2),
+            value.transpose(1, 2),
+            attn_mask=bias.to(q_with_bias_u.dtype),
+            dropout_p=self.dropout if self.training else 0.0,
+            scale=self.scale,
+        )  # (batch, head, time1, d_k)
+        x = x.transpose(1, 2).reshape(bsz, qlen, self.vhead_dim * self.num_heads)
+        return self.out_proj(x)
+
 
 class MultiheadAttention(nn.Module):
     """The class is a wrapper of MultiHead Attention for torch.nn.MultiHeadAttention.
+    The inputs are batch first, which torch.nn.MultiHeadAttention takes as is. Without
+    the attention weights, it can use the fused attention kernels.
 
     Reference: https://pytorch.org/docs/stable/nn.html
 
@@ -714,8 +904,73 @@ class MultiheadAttention(nn.Module):
             add_zero_attn=add_zero_attn,
             kdim=kdim,
             vdim=vdim,
+            batch_first=True,
         )
 
+    def _in_proj(self):
+        """The weights and the biases of the query, key and value projections"""
+        att = self.att
+        if att._qkv_same_embed_dim:
+            weights = att.in_proj_weight.chunk(3)
+        else:
+            weights = (att.q_proj_weight, att.k_proj_weight, att.v_proj_weight)
+        if att.in_proj_bias is not None:
+            biases = att.in_proj_bias.chunk(3)
+        else:
+            biases = (None, None, None)
+        return weights, biases
+
+    def _heads(self, x):
+        # (batch, time, fea) -> (batch, head, time, d_k)
+        return x.view(x.size(0), x.size(1), self.att.num_heads, -1).transpose(1, 2)
+
+    def project_kv(self, key, value):
+        """The keys and values of the heads (B, num_heads, S, head_dim) of a fixed key and value,
+        e.g. the reference, to be passed as kv to forward instead of projecting them every call.
+        """
+        if self.att.bias_k is not None:
+            raise ValueError("project_kv does not support add_bias_kv=True")
+        if self.att.add_zero_attn:
+            raise ValueError("project_kv does not support add_zero_attn=True")
+        (_, w_k, w_v), (_, b_k, b_v) = self._in_proj()
+        key = self._heads(F.linear(key, w_k, b_k))
+        value = self._heads(F.linear(value, w_v, b_v))
+        return key, value
+
+    def _forward_kv(self, query, kv, attn_mask, key_padding_mask):
+        """The attention of query to the projected keys and values of project_kv"""
+        (w_q, _, _), (b_q, _, _) = self._in_proj()
+        bsz, qlen, _ = query.shape
+        query = self._heads(F.linear(query, w_q, b_q))
+        ## the same keys and values may be shared by the whole batch
+        key, value = (x.expand(bsz, -1, -1, -1) for x in kv)
+        klen = key.size(2)
+        mask = None
+        if attn_mask is not None:
+            if attn_mask.ndim == 3:
+                attn_mask = attn_mask.view(bsz, -1, qlen, klen)
+            if attn_mask.dtype == torch.bool:
+                mask = torch.zeros(
+                    attn_mask.shape, dtype=query.dtype, device=query.device
+                ).masked_fill(attn_mask, float("-inf"))
+            else:
+                mask = attn_mask.to(query.dtype)
+        if key_padding_mask is not None:
+            padding = torch.zeros(
+                key_padding_mask.shape, dtype=query.dtype, device=query.device
+            ).masked_fill(key_padding_mask.bool(), float("-inf"))
+            padding = padding.view(bsz, 1, 1, klen)
+            mask = padding if mask is None else mask + padding
+        x = F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=mask,
+            dropout_p=self.att.dropout if self.training else 0.0,
+        )  # (batch, head, time1, d_k)
+        x = x.transpose(1, 2).reshape(bsz, qlen, -1)
+        return self.att.out_proj(x)
+
     def forward(
         self,
         query,
@@ -725,6 +980,7 @@ class MultiheadAttention(nn.Module):
         key_padding_mask: Optional[torch.Tensor] = None,
         return_attn_weights: Optional[torch.Tensor] = True,
         pos_embs: Optional[torch.Tensor] = None,
+        kv: Optional[tuple] = None,
     ):
         """
         Arguments
@@ -756,8 +1012,13 @@ class MultiheadAttention(nn.Module):
             be unchanged. If a BoolTensor is provided, positions with True is
             not allowed to attend while False values will be unchanged. If a
             FloatTensor is provided, it will be added to the attention weight.
+        return_attn_weights : bool
+            Whether to return the attention weights.
         pos_embs: torch.Tensor, optional
             Positional embeddings added to the attention map of shape (L, S, E) or (L, S, 1).
+        kv: tuple, optional
+            The keys and values from project_kv, used instead of key and value.
+            The attention weights are not computed with them, None is returned instead.
 
         Outputs
         -------
@@ -767,12 +1028,8 @@ class MultiheadAttention(nn.Module):
         attn_output_weights : torch.Tensor
             (B, L, S) where B is the batch size, L is the target
             sequence length, S is the source sequence length.
+            Only if return_attn_weights.
         """
-        # give tensors of shape (time, batch, fea)
-        query = query.permute(1, 0, 2)
-        key = key.permute(1, 0, 2)
-        value = value.permute(1, 0, 2)
-
         # this will be legit because of https://github.com/pytorch/pytorch/blob/5288d05cfdda85c46c4df84617fa7f37c21b10b3/torch/nn/functional.py#L4946
         # we can inject relative learnable pos embeddings directly in MHA via the attn_mask
         if pos_embs is not None:
@@ -781,6 +1038,10 @@ class MultiheadAttention(nn.Module):
             else:
                 attn_mask = pos_embs
 
+        if kv is not None:
+            output = self._forward_kv(query, kv, attn_mask, key_padding_mask)
+            return (output, None) if return_attn_weights else output
+
         output = self.att(
             query,
             key,
@@ -792,11 +1053,9 @@ class MultiheadAttention(nn.Module):
 
         if return_attn_weights:
             output, attention_weights = output
-            # reshape the output back to (batch, time, fea)
-            output = output.permute(1, 0, 2)
             return output, attention_weights
         else:
-            output = output.permute(1, 0, 2)
+            output, _ = output
             return output
 
 
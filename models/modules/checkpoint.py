@@ -0,0 +1,42 @@
+"""
+Per-layer activation checkpointing.
+"""
+
+import functools
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def _checkpointed_forward(layer, forward, *args, **kwargs):
+    if layer.training and torch.is_grad_enabled():
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return forward(*args, **kwargs)
+
+
+def checkpoint_layers(layers, which=True):
+    """Enable activation checkpointing for the layers of a ModuleList in place.
+    The activations inside a checkpointed layer are recomputed in backward instead of being kept,
+    only during training. The parameters and the state dict are unchanged.
+
+    Arguments
+    ---------
+    layers: torch.nn.ModuleList
+        The layers, e.g. the layers of a transformer encoder.
+    which: bool or List[int]
+        True for all the layers, False or None for none, or the indices of the layers to checkpoint.
+
+    Returns
+    -------
+    idxes: List[int]
+        The indices of the checkpointed layers.
+    """
+    if which is True:
+        idxes = list(range(len(layers)))
+    elif not which:
+        idxes = []
+    else:
+        idxes = [int(i) for i in which]
+    for i in idxes:
+        layer = layers[i]
+        layer.forward = functools.partial(_checkpointed_forward, layer, layer.forward)
+    return idxes
@@ -4,6 +4,7 @@ from typing import Optional
 import numpy as np
 from . import attention
 from . import normalization
+from .checkpoint import checkpoint_layers
 
 
 class TransformerEncoderLayerCross(nn.Module):
@@ -71,6 +72,10 @@ class TransformerEncoderLayerCross(nn.Module):
             self.self_att = attention.RelPosMHAXL(
                 d_model, nhead, dropout, mask_pos_future=causal
             )
+        ## src attends to embd, RelPosMHAXL does not need to compare them
+        self.att_kwargs = (
+            {"self_attention": False} if attention_type == "RelPosMHAXL" else {}
+        )
 
         self.pos_ffn = attention.PositionalwiseFeedForward(
             d_ffn=d_ffn,
@@ -93,6 +98,12 @@ class TransformerEncoderLayerCross(nn.Module):
 
         self.normalize_before = normalize_before
 
+    def project_kv(self, embd):
+        """
+        The keys and values of embd in the attention, which can be passed as kv to forward instead of embd
+        """
+        return self.self_att.project_kv(embd, embd)
+
     def forward(
         self,
         src,
@@ -100,6 +111,8 @@ class TransformerEncoderLayerCross(nn.Module):
         src_mask: Optional[torch.Tensor] = None,
         src_key_padding_mask: Optional[torch.Tensor] = None,
         pos_embs: Optional[torch.Tensor] = None,
+        return_attn_weights: bool = False,
+        kv: Optional[tuple] = None,
     ):
         """
         Arguments
@@ -110,6 +123,11 @@ class TransformerEncoderLayerCross(nn.Module):
             The mask for the src query for each example in the batch.
         src_key_padding_mask : torch.Tensor, optional
             The mask for the src keys for each example in the batch.
+        return_attn_weights : bool
+            Whether to return the attention map, None otherwise.
+            Without it, the attention can use the fused kernels.
+        kv : tuple, optional
+            The keys and values of embd from project_kv, embd is not used if given.
         """
 
         if self.normalize_before:
@@ -121,7 +139,7 @@ class TransformerEncoderLayerCross(nn.Module):
         # k = self.conv1d2(torch.cat([src1,embd], -1).permute(0,2,1).contiguous())
         # v = self.conv1d3(torch.cat([src1,embd], -1).permute(0,2,1).contiguous())
 
-        output, self_attn = self.self_att(
+        output = self.self_att(
             # query = q.permute(0,2,1).contiguous(),
             # key = k.permute(0,2,1).contiguous(),
             # value = v.permute(0,2,1).contiguous(),
@@ -134,7 +152,14 @@ class TransformerEncoderLayerCross(nn.Module):
             attn_mask=src_mask,
             key_padding_mask=src_key_padding_mask,
             pos_embs=pos_embs,
+            return_attn_weights=return_attn_weights,
+            kv=kv,
+            **self.att_kwargs,
         )
+        if return_attn_weights:
+            output, self_attn = output
+        else:
+            self_attn = None
 
         # add & norm
         src = src + self.dropout1(output)
@@ -176,6 +201,9 @@ class TransformerEncoderCross(nn.Module):
     input_module: torch class
         The module to process the source input feature to expected
         feature dimension (Optional).
+    activation_checkpointing: bool or List[int]
+        Whether to recompute the activations of the layers in backward instead of keeping them,
+        True for all the layers or the indices of the layers (Optional).
 
     Example
     -------
@@ -202,6 +230,7 @@ class TransformerEncoderCross(nn.Module):
         causal=False,
         layerdrop_prob=0.0,
         attention_type="regularMHA",
+        activation_checkpointing=False,
     ):
         super().__init__()
 
@@ -225,6 +254,17 @@ class TransformerEncoderCross(nn.Module):
         self.norm = normalization.LayerNorm(d_model, eps=1e-6)
         self.layerdrop_prob = layerdrop_prob
         self.rng = np.random.default_rng()
+        self.checkpointed_layers = checkpoint_layers(
+            self.layers, activation_checkpointing
+        )
+
+    def project_kv(self, embd):
+        """
+        The keys and values of embd in every layer. They can be passed as kv to forward instead of embd
+        when the same embd is attended to repeatedly, e.g. the reference of a speaker in inference,
+        so that only the src side runs every call.
+        """
+        return [layer.project_kv(embd) for layer in self.layers]
 
     def forward(
         self,
@@ -233,6 +273,8 @@ class TransformerEncoderCross(nn.Module):
         src_mask: Optional[torch.Tensor] = None,
         src_key_padding_mask: Optional[torch.Tensor] = None,
         pos_embs: Optional[torch.Tensor] = None,
+        return_attention: bool = False,
+        kv: Optional[list] = None,
     ):
         """
         Arguments
@@ -243,6 +285,10 @@ class TransformerEncoderCross(nn.Module):
             The mask for the src sequence (optional).
         src_key_padding_mask : tensor
             The mask for the src keys per batch (optional).
+        return_attention : bool
+            Whether to collect the attention maps of the layers, the returned list is empty otherwise.
+        kv : list, optional
+            The keys and values of embd of every layer from project_kv, embd is not used if given.
         """
         output = src
         if self.layerdrop_prob > 0.0:
@@ -262,8 +308,10 @@ class TransformerEncoderCross(nn.Module):
                     src_mask=src_mask,
                     src_key_padding_mask=src_key_padding_mask,
                     pos_embs=pos_embs,
+                    return_attn_weights=return_attention,
+                    kv=kv[i] if kv is not None else None,
                 )
-
-                attention_lst.append(attention)
+                if return_attention:
+                    attention_lst.append(attention)
         output = self.norm(output)
         return output, attention_lst
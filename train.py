@@ -4,6 +4,7 @@ import random
 import numpy as np
 import sys
 import os
+import signal
 import yaml
 
 sys.path.append(os.getcwd())
@@ -12,14 +13,16 @@ sys.path.append(os.getcwd())
 import logging
 import datetime
 
-from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import torch.multiprocessing as mp
 import torch.distributed as dist
 
 from torch.utils.data import DataLoader
 from hyperpyyaml import load_hyperpyyaml
 from utils.env import AttrDict
+from dataset import ShardSampler
+from trainer.comm import build_ddp
 from functools import partial
 
 
@@ -39,9 +42,24 @@ def seed_worker(seed, worker_id):
 
 
 ## ddp process
-def setup(rank, world_size, backend, port=12355):
-    os.environ["MASTER_ADDR"] = "127.0.0.1"
-    os.environ["MASTER_PORT"] = str(port)
+def get_dist_env():
+    """
+    Return (rank, local_rank, world_size) set by torchrun, None if not launched by torchrun
+    """
+    if "RANK" not in os.environ or "LOCAL_RANK" not in os.environ:
+        return None
+    return (
+        int(os.environ["RANK"]),
+        int(os.environ["LOCAL_RANK"]),
+        int(os.environ["WORLD_SIZE"]),
+    )
+
+
+def setup(rank, world_size, backend, port=12355, from_env=False):
+    if not from_env:
+        ## mp.spawn on a single host, torchrun sets the master address and port itself
+        os.environ["MASTER_ADDR"] = "127.0.0.1"
+        os.environ["MASTER_PORT"] = str(port)
     # initialize the process group
     dist.init_process_group(backend, rank=rank, world_size=world_size)
 
@@ -50,15 +68,54 @@ def cleanup():
     dist.destroy_process_group()
 
 
-def setup_logger(args):
+def forward_signal(context, signum):
+    """
+    Forward signum received by the launching process to the rank processes of mp.spawn,
+    e.g. SIGUSR1 to start a profiler capture, instead of terminating the job
+    """
+
+    def handler(signum, frame):
+        for pid in context.pids():
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signum, handler)
+
+
+def setup_cpu_threads(local_rank, local_world_size, num_workers):
+    """
+    Split the cores of the host between the ranks when training on cpu.
+    Every rank is pinned to its own share of the cores, which its data loader workers inherit,
+    and runs its intra-op threads on the cores left by the workers.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        torch.set_num_threads(max(os.cpu_count() // local_world_size, 1))
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    per_rank = max(len(cores) // local_world_size, 1)
+    cores = cores[local_rank * per_rank : (local_rank + 1) * per_rank] or cores
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(len(cores) - num_workers, 1))
+    return cores
+
+
+def setup_logger(args, local_rank=0):
     now = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     log_dir = args.log
     print(f"logging dir: {log_dir}")
     os.makedirs(log_dir, exist_ok=True)
+    handlers = [logging.StreamHandler()]
+    if local_rank == 0:
+        ## one log file per node, the one of the first node has the training log
+        node = int(os.environ.get("GROUP_RANK", 0))
+        name = f"{now}.log" if node == 0 else f"{now}_node{node}.log"
+        handlers.append(logging.FileHandler(f"{log_dir}/{name}"))
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s,%(name)s,%(levelname)s,%(message)s",
-        handlers=[logging.FileHandler(f"{log_dir}/{now}.log"), logging.StreamHandler()],
+        handlers=handlers,
     )
     logger = logging.getLogger()
     logger.info("logger initialized")
@@ -76,34 +133,104 @@ def setup_seed(seed, rank):
     return SEED
 
 
-def main(rank, args):
+def main(local_rank, args, dist_env=None):
     with open(args.config_path, "r") as f:
         config_base = AttrDict(**yaml.load(f, Loader=yaml.BaseLoader))
-        config_base.world_size = len(config_base.gpus)
-    print(f"rank {rank} of world_size {config_base.world_size} started...")
+    if dist_env is None:
+        ## mp.spawn, one process per gpu of the config
+        rank, world_size = local_rank, len(config_base.gpus)
+    else:
+        rank, local_rank, world_size = dist_env
+    ## the profiler signal must not kill a rank without profiler, the profiler installs its own handler
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    config_base.world_size = world_size
+    print(f"rank {rank} (local rank {local_rank}) of world_size {world_size} started...")
     setup_seed(config_base.seed, rank)
-    setup(rank, config_base.world_size, args.dist_backend, port=int(config_base.port))
+    device_type = args.device
+    if device_type is None:
+        device_type = "cuda" if torch.cuda.is_available() else "cpu"
+    backend = args.dist_backend
+    if backend == "nccl" and device_type == "cpu":
+        print("training on cpu, using the gloo backend")
+        backend = "gloo"
+    setup(
+        rank,
+        world_size,
+        backend,
+        port=int(config_base.port),
+        from_env=dist_env is not None,
+    )
     ## logger
-    logger = setup_logger(args)
+    logger = setup_logger(args, local_rank)
+    if os.environ.get("TORCHELASTIC_RESTART_COUNT", "0") != "0":
+        logger.info(
+            f"elastic restart {os.environ['TORCHELASTIC_RESTART_COUNT']}, resuming from the latest checkpoint"
+        )
     with open(args.config_path, "r") as f:
         config = AttrDict(**load_hyperpyyaml(f))
-        config.world_size = len(config.gpus)
-    torch.cuda.set_device(rank)
-    torch.cuda.empty_cache()
+        config.world_size = world_size
+        config.log_dir = args.log
+    if device_type == "cuda":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+        torch.cuda.empty_cache()
+    else:
+        device = torch.device("cpu")
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        cores = setup_cpu_threads(local_rank, local_world_size, config.num_workers)
+        print(
+            f"rank {rank} on cores {cores} with {torch.get_num_threads()} threads"
+        )
     ### prepare model
-    model = config.model.cuda(rank)
-    model.to(rank)
+    model = config.model.to(device)
 
-    model = DDP(model, device_ids=[rank], find_unused_parameters=config.find_unused)
+    ## the frozen WavLM and HiFi-GAN are not part of the module tree of the model,
+    ## so DDP only wraps (and syncs) the trainable submodules
+    model = build_ddp(model, device, config)
     tr_dataset = config.tr_dataset(rank=rank)
+    ## the batch of one optimizer step is split into accum_steps micro-batches
+    micro_batch_size = (
+        config.batch_size // config.world_size // (config.accum_steps or 1)
+    )
+    if config.tr_batch_sampler is not None:
+        ## the batch sampler decides the batch composition, e.g. utterance reuse
+        tr_loader_kwargs = dict(
+            batch_sampler=config.tr_batch_sampler(
+                dataset=tr_dataset,
+                batch_size=micro_batch_size,
+                rank=rank,
+                world_size=config.world_size,
+                seed=config.sampler_seed,
+            )
+        )
+    else:
+        tr_loader_kwargs = dict(
+            batch_size=micro_batch_size,
+            shuffle=False,
+            sampler=(
+                config.tr_sampler(
+                    dataset=tr_dataset,
+                    rank=rank,
+                    world_size=config.world_size,
+                    seed=config.sampler_seed,
+                )
+                if config.tr_sampler is not None
+                else DistributedSampler(
+                    dataset=tr_dataset, seed=config.sampler_seed + rank
+                )
+            ),
+        )
     tr_data = DataLoader(
         tr_dataset,
-        batch_size=config.batch_size // config.world_size,
-        shuffle=False,
-        sampler=DistributedSampler(dataset=tr_dataset, seed=config.sampler_seed + rank),
+        **tr_loader_kwargs,
         num_workers=config.num_workers,
-        collate_fn=config.collate_fn,
+        collate_fn=(
+            config.tr_collate_fn
+            if config.tr_collate_fn is not None
+            else config.collate_fn
+        ),
         worker_init_fn=partial(seed_worker, int(config_base.seed) + rank * 10000),
+        pin_memory=device.type == "cuda",
     )
     cv_dataset = config.cv_dataset(rank=rank)
     cv_data = DataLoader(
@@ -114,12 +241,22 @@ def main(rank, args):
             else config.batch_size // config.world_size
         ),
         shuffle=False,
+        ## every rank evaluates its own shard of the dev set
+        sampler=ShardSampler(cv_dataset, rank, config.world_size),
         num_workers=config.num_workers,
         collate_fn=config.collate_fn,
         worker_init_fn=partial(seed_worker, int(config_base.seed) + rank * 10000),
+        pin_memory=device.type == "cuda",
     )
 
-    optim = config.optim(params=filter(lambda p: p.requires_grad, model.parameters()))
+    params = [p for p in model.parameters() if p.requires_grad]
+    if config.zero:
+        ## ZeRO-1, every rank only keeps the optimizer state of its shard of the parameters
+        optim = ZeroRedundancyOptimizer(
+            params, optimizer_class=config.optim.func, **config.optim.keywords
+        )
+    else:
+        optim = config.optim(params=params)
     ### start training loop
 
     trainer_class = config.trainer
@@ -130,7 +267,7 @@ def main(rank, args):
         optim,
         config,
         args.ckpt_path,
-        rank,
+        device,
         rank,
         logger,
     )
@@ -148,11 +285,32 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dist-backend", default="nccl", type=str, help="distributed backend"
     )
+    parser.add_argument(
+        "--device",
+        choices=["cuda", "cpu"],
+        default=None,
+        help="The device to train on, cuda if available by default. On cpu the gloo backend is used.",
+    )
     args = parser.parse_args()
     os.makedirs(args.ckpt_path, exist_ok=True)
-    with open(args.config_path, "r") as f:
-        config_base = AttrDict(**yaml.load(f, Loader=yaml.BaseLoader))
-    os.environ["CUDA_VISIBLE_DEVICES"] = ",".join([str(i) for i in config_base.gpus])
-    mp.spawn(main, args=(args,), nprocs=len(config_base.gpus), join=True)
+    dist_env = get_dist_env()
+    if dist_env is not None:
+        ## launched by torchrun, which runs one process per gpu of every node
+        main(dist_env[1], args, dist_env)
+    else:
+        with open(args.config_path, "r") as f:
+            config_base = AttrDict(**yaml.load(f, Loader=yaml.BaseLoader))
+        ## on cpu, the number of entries of gpus is the number of processes
+        os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(
+            [str(i) for i in config_base.gpus]
+        )
+        ## ignored until the handler is installed, the ranks start with it ignored too
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        context = mp.spawn(
+            main, args=(args,), nprocs=len(config_base.gpus), join=False
+        )
+        forward_signal(context, signal.SIGUSR1)
+        while not context.join():
+            pass
 
     pass
@@ -1,32 +1,31 @@
 ### The base class for abstract trainer class
 import torch
 import os
+import os.path as op
 import time
+import json
+import contextlib
 import torch.distributed as dist
 from torch.utils.data import Subset, DataLoader
-from .helper import dict_to_str, save, load_ckpt
+from .helper import (
+    dict_to_str,
+    load_ckpt,
+    add_result,
+    normalize_result,
+    to_cpu,
+    AsyncCheckpointWriter,
+    MetricAggregator,
+    AsyncMetrics,
+    get_rng_state,
+    set_rng_state,
+    torch_load,
+    broadcast_ckpt,
+)
+from .timer import StepTimer
 import random
 
-
-def gather_tensors(tensor):
-    """
-    Gather tensors from all GPUs.
-    """
-    tensor_list = [torch.zeros_like(tensor) for _ in range(dist.get_world_size())]
-    dist.all_gather(tensor_list, tensor)
-    return tensor_list
-
-
-def get_avg_result(res: dict):
-    """
-    This method is called to collect the average results from evaluation.
-    """
-    new_res = {}
-    for k, v in res.items():
-        tensors = gather_tensors(v)
-        value = sum(t.item() for t in tensors) / len(tensors)
-        new_res[k] = value
-    return new_res
+## the dtype to autocast to for each precision mode
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
 
 
 class AbsTrainer:
@@ -48,39 +47,125 @@ class AbsTrainer:
         self.config = config
         self.ckpt_dir = ckpt_path
         self.epoch_start = 0
+        self.batch_start = 0
         self.step = 0
         self.cv_log = {}
         self.optim = optim
         self.device = device
+        self.device_type = "cuda" if isinstance(device, int) else torch.device(device).type
         self.rank = rank
         print(f"device is {self.device} for rank {rank}")
+        ## mixed precision
+        self.precision = config.precision if config.precision is not None else "fp32"
+        assert (
+            self.precision in PRECISIONS
+        ), f"precision should be one of {list(PRECISIONS.keys())}"
+        self.amp_dtype = PRECISIONS[self.precision]
+        if hasattr(torch.amp, "GradScaler"):
+            self.scaler = torch.amp.GradScaler(
+                self.device_type, enabled=self.precision == "fp16"
+            )
+        else:
+            ## torch < 2.3 only has the cuda scaler
+            self.scaler = torch.cuda.amp.GradScaler(
+                enabled=self.precision == "fp16" and self.device_type == "cuda"
+            )
+        ## gradient accumulation, each batch of tr_data is a micro-batch
+        self.accum_steps = config.accum_steps if config.accum_steps is not None else 1
+        self._accum_size = 1
+        self._accum_boundary = True
         self.log_interval = config.log_interval
         self.logger = logger
+        ## the per step time of each phase, written to the log and to a json lines file per rank
+        self.timer = StepTimer(self.device, enabled=config.step_timing is not False)
+        if config.allreduce_timing and getattr(self.model, "comm_state", None) is not None:
+            ## the gradient all-reduce is timed by the comm hook of trainer.comm.build_ddp
+            self.model.comm_state.timer = self.timer
+        self.metrics_file = None
+        if self.timer.enabled and config.log_dir is not None:
+            self.metrics_file = open(
+                op.join(config.log_dir, f"steps_rank{rank}.jsonl"), "a"
+            )
+        ## scheduled torch.profiler captures, the traces are exported to <log>/traces
+        self.profiler = config.profiler
+        if self.profiler is not None:
+            self.profiler = self.profiler(
+                out_dir=op.join(config.log_dir or ".", "traces"), rank=rank
+            )
         self.max_ckpt = config.max_ckpt
+        ## also save a checkpoint every save_interval_steps optimizer steps within the epoch
+        self.save_interval_steps = config.save_interval_steps
+        self.rng_state = None
         self.best_field = config.best_field
         self.best_value = None
         self.best_save_type = config.best_save_type
-        self.ckpt_path = load_ckpt(self.ckpt_dir)
+        ## every rank resumes from the checkpoint rank 0 picks and broadcasts
+        ckpt_path = [load_ckpt(self.ckpt_dir) if rank == 0 else None]
+        dist.broadcast_object_list(ckpt_path, src=0)
+        self.ckpt_path = ckpt_path[0]
+        self.ckpt_writer = AsyncCheckpointWriter()
         ckpt_path = self.ckpt_path
         self.scheduler = config.scheduler
         random.seed(config.seed + rank)
         if self.scheduler is not None:
             self.scheduler = self.scheduler(optimizer=self.optim)
         self.new_bob = config.new_bob
+        self.mixer = config.tr_mixer
+        if self.mixer is not None:
+            ## batched dynamic mixing on the training device
+            self.mixer = self.mixer(seed=config.seed + rank, device=device)
         if ckpt_path is not None:
-            ## loading ckpt
+            ## loading ckpt, only rank 0 reads the file and broadcasts it to the other ranks
             self._log(f"loading model from {ckpt_path}...")
-            ckpt = torch.load(ckpt_path, map_location="cpu")
-            torch.cuda.empty_cache()
+            ckpt = None
+            if rank == 0:
+                ckpt = torch_load(ckpt_path)
+                module = self.model.module
+                if hasattr(module, "filter_frozen"):
+                    ## older checkpoints still have the weights of the frozen models
+                    ckpt["model_state_dict"] = module.filter_frozen(
+                        ckpt["model_state_dict"]
+                    )
+            ckpt = broadcast_ckpt(
+                ckpt, rank, self.device if dist.get_backend() == "nccl" else "cpu"
+            )
             self.model.module.load_state_dict(ckpt["model_state_dict"])
-            self.optim.load_state_dict(ckpt["optim"])
+            self._check_frozen(ckpt.get("frozen_fingerprint"))
             self.epoch_start = ckpt["epoch"] + 1
+            batch = ckpt.get("batch")
+            if batch is not None and batch < len(self.tr_data):
+                ## the checkpoint is in the middle of an epoch
+                self.epoch_start = ckpt["epoch"]
+                self.batch_start = batch
             self.step = ckpt["step"]
             self.cv_log = ckpt["cv_log"]
             self.best_value = ckpt[self.best_field]
             self.optim.load_state_dict(ckpt["optim"])
+            ## a disabled scaler (fp32, bf16) saves an empty state, which would not load
+            if ckpt.get("scaler"):
+                self.scaler.load_state_dict(ckpt["scaler"])
             self.scheduler = ckpt["scheduler"]
             self.new_bob = ckpt["new_bob"]
+            rng_states = ckpt.get("rng_states")
+            if rng_states is not None and len(rng_states) == dist.get_world_size():
+                ## restored when the training resumes
+                self.rng_state = rng_states[rank]
+            elif rng_states is not None:
+                self._log("the world size changed, the random states are not restored")
+
+    def _frozen_fingerprint(self):
+        ## the checkpoints only have the trainable parameters
+        module = self.model.module
+        if hasattr(module, "frozen_fingerprint"):
+            return module.frozen_fingerprint()
+        return None
+
+    def _check_frozen(self, fingerprint):
+        if self.rank == 0 and fingerprint is not None:
+            if fingerprint != self._frozen_fingerprint():
+                self._log(
+                    "WARNING! the frozen models differ from the ones the checkpoint was trained with"
+                )
 
     def _log(self, msg):
         if self.rank == 0:
@@ -100,71 +185,209 @@ class AbsTrainer:
         elif self.scheduler is not None:
             self.scheduler.step()
 
-    def _save(self, model, cv_log, epoch, optim, path, step, save_best: bool):
+    def _save(
+        self, model, cv_log, epoch, optim, path, step, save_best: bool, batch=None
+    ):
+        """
+        batch: the number of batches of the epoch done, defaults to the whole epoch
+        """
+        ## the random states of every rank, to continue exactly
+        rng_states = [None] * dist.get_world_size()
+        dist.all_gather_object(rng_states, get_rng_state())
+        if hasattr(optim, "consolidate_state_dict"):
+            ## a sharded optimizer, gather the full state on rank 0
+            optim.consolidate_state_dict(to=0)
         if self.rank == 0:
             self._log(f"saving model... for epoch {epoch}")
             content = {
                 "epoch": epoch,
                 "step": step,
+                "batch": len(self.tr_data) if batch is None else batch,
                 "model_state_dict": model.module.state_dict(),
+                "frozen_fingerprint": self._frozen_fingerprint(),
                 "optim": optim.state_dict(),
+                "scaler": self.scaler.state_dict(),
                 "cv_log": cv_log,
                 "scheduler": self.scheduler,
                 "new_bob": self.new_bob,
+                "rng_states": rng_states,
                 self.best_field: self.best_value,
             }
-            save(
+            best_path = None
+            if save_best:
+                self._log(f"saving the best model of epoch {epoch}")
+                best_path = op.join(op.dirname(path), "best.pth")
+            ## snapshot to cpu and write in the background
+            self.ckpt_writer.submit(
                 path,
-                content,
+                to_cpu(content),
                 self.max_ckpt,
+                best_path=best_path,
             )
-            if save_best:
-                self._log(f"saving the best model of epoch {epoch}")
-                torch.save(content, path.replace(f"epoch{epoch}.pth", f"best.pth"))
         pass
 
+    def _autocast(self):
+        """
+        The autocast context of the forward pass according to the precision mode
+        """
+        return torch.autocast(
+            self.device_type,
+            dtype=self.amp_dtype,
+            enabled=self.amp_dtype is not None,
+        )
+
+    def _backward(self, loss):
+        ## average the loss over the micro-batches of the optimizer step
+        self.scaler.scale(loss / self._accum_size).backward()
+
+    def _optim_step(self, optim):
+        if not self._accum_boundary:
+            ## keep accumulating the gradients
+            return
+        ## the scaler is a no-op unless the precision is fp16
+        self.scaler.step(optim)
+        self.scaler.update()
+        optim.zero_grad()
+
     def _train_one_batch(self, batch, data, optim, if_log) -> dict:
         raise NotImplementedError("not implemented")
 
     def _eval_one_batch(self, data) -> dict:
         raise NotImplementedError("not implemented")
 
-    def _train(self, optim, tr_data, epoch):
+    def _set_epoch(self, tr_data, epoch):
+        ## the epoch is kept either by the sampler or by a custom batch sampler
+        for sampler in (tr_data.sampler, tr_data.batch_sampler):
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch)
+
+    def _seek(self, tr_data, batch):
+        """
+        Position the sampler of the current epoch at the given batch without loading the skipped data.
+        Return the batch the epoch starts from.
+        """
+        if hasattr(tr_data.batch_sampler, "seek"):
+            tr_data.batch_sampler.seek(batch)
+        elif hasattr(tr_data.sampler, "seek"):
+            tr_data.sampler.seek(batch * tr_data.batch_size)
+        else:
+            self._log(f"the sampler is not seekable, restart the epoch from the beginning")
+            return 0
+        self._log(f"resume the epoch from batch {batch}")
+        return batch
+
+    def _train_data(self, tr_data, start_batch):
+        """
+        The iterable of the training batches of an epoch, tr_data by default
+        """
+        return tr_data
+
+    def _batch_size(self, data_loader):
+        if data_loader.batch_size is not None:
+            return data_loader.batch_size
+        return data_loader.batch_sampler.batch_size
+
+    def _log_step(self, metrics, interval, info):
+        """
+        Log the metrics and the step timing of a log interval
+        """
+        timing = interval.result()
+        if self.metrics_file is not None:
+            record = {"rank": self.rank, "epoch": info["epoch"], "step": info["step"]}
+            record.update(timing)
+            self.metrics_file.write(json.dumps(record) + "\n")
+            self.metrics_file.flush()
+        if metrics is not None:
+            res = metrics.result()
+            res.update({k: f"{v:.2f}" for k, v in timing.items()})
+            self._log(f"tr, {dict_to_str(res)}")
+
+    def _train(self, optim, tr_data, epoch, start_batch=0):
         self.model.train()
-        total = len(tr_data) * tr_data.batch_size
+        batch_size = self._batch_size(tr_data)
+        total = len(tr_data) * batch_size
         start_time = time.time()
-        for batch, data in enumerate(tr_data):
-            if_log = batch % self.log_interval == 0
-            res = self._train_one_batch(batch, data, optim, if_log)
+        step_res = {}
+        ## the metrics of the last log interval, logged once they have reached the host
+        pending = None
+        self.timer.reset()
+        for batch, data in enumerate(
+            self.timer.iterate(self._train_data(tr_data, start_batch)),
+            start=start_batch,
+        ):
+            ## the optimizer step of the epoch this micro-batch belongs to
+            window = batch // self.accum_steps
+            self._accum_size = min(
+                self.accum_steps, len(tr_data) - window * self.accum_steps
+            )
+            self._accum_boundary = batch + 1 == window * self.accum_steps + self._accum_size
+            if self.profiler is not None and batch % self.accum_steps == 0:
+                self.profiler.step(self.step)
+            if_log = window % self.log_interval == 0
+            ## only sync the gradients across ranks on the last micro-batch
+            sync = (
+                self.model.no_sync()
+                if not self._accum_boundary and hasattr(self.model, "no_sync")
+                else contextlib.nullcontext()
+            )
+            with sync:
+                res = self._train_one_batch(batch, data, optim, if_log)
+            self.timer.batch_done(len(data[0]))
             if if_log:
-                current = (batch + 1) * tr_data.batch_size
-                res["epoch"] = epoch
-                res["step"] = self.step
-                res["p"] = f"[{current:>5d}/{total:>5d}]"
-                res["time/batch"] = (
-                    f"{(time.time() - start_time)*1000 / self.log_interval :.2f}ms"
-                )
+                step_res = add_result(step_res, res)
+            if not self._accum_boundary:
+                continue
+            if if_log:
+                res = normalize_result(step_res, self._accum_size)
+                step_res = {}
+                current = (batch + 1) * batch_size
+                info = {
+                    "epoch": epoch,
+                    "step": self.step,
+                    "p": f"[{current:>5d}/{total:>5d}]",
+                    "time/batch": f"{(time.time() - start_time)*1000 / self.log_interval :.2f}ms",
+                }
                 start_time = time.time()
-                self._log(f"tr, {dict_to_str(res)}")
+                ## log without waiting for the device, the previous metrics are ready by now
+                if pending is not None:
+                    self._log_step(*pending)
+                pending = (
+                    AsyncMetrics(res, **info) if self.rank == 0 else None,
+                    self.timer.interval(),
+                    info,
+                )
             self.step += 1
+            if (
+                self.save_interval_steps
+                and self.step % self.save_interval_steps == 0
+                and batch + 1 < len(tr_data)
+            ):
+                ## a step checkpoint to resume from the next batch of the epoch
+                self._save(
+                    self.model,
+                    self.cv_log,
+                    epoch,
+                    optim,
+                    op.join(self.ckpt_dir, f"epoch{epoch}_step{self.step}.pth"),
+                    self.step,
+                    False,
+                    batch=batch + 1,
+                )
+        if pending is not None:
+            self._log_step(*pending)
 
     def _eval(self, cv_data, epoch):
         self.model.eval()
-        result = None
+        metrics = MetricAggregator()
         if self.rank == 0:
             print("evaluating...")
         with torch.no_grad():
             for data in cv_data:
                 res = self._eval_one_batch(data)
-                if result == None:
-                    result = res
-                else:
-                    for key in result.keys():
-                        result[key] += res[key]
-        for key in result.keys():
-            result[key] = result[key] / len(cv_data)
-        ## gather all tensors onto the same device
-        result = get_avg_result(result)
+                ## weight by the batch size as the last batch may be smaller
+                metrics.add(res, len(data[0]))
+        ## average over all the ranks, each of which evaluates its own shard
+        result = metrics.reduce()
         self._log(f"eval epoch {epoch} {dict_to_str(result)}")
         if epoch != -1:
             self.cv_log[epoch] = result
@@ -186,9 +409,15 @@ class AbsTrainer:
             )
         for epoch in range(self.epoch_start, self.config["epoch"]):
             self._log(f"...epoch {epoch}...")
-            self.tr_data.sampler.set_epoch(epoch)
+            self._set_epoch(self.tr_data, epoch)
+            start_batch = 0
+            if epoch == self.epoch_start and self.batch_start > 0:
+                start_batch = self._seek(self.tr_data, self.batch_start)
+            if epoch == self.epoch_start and self.rng_state is not None:
+                set_rng_state(self.rng_state)
+                self.rng_state = None
             ### training
-            self._train(self.optim, self.tr_data, epoch)
+            self._train(self.optim, self.tr_data, epoch, start_batch)
             #### evaluation
             result = self._eval(self.cv_data, epoch)
             if self.best_value is None:
@@ -214,3 +443,7 @@ class AbsTrainer:
             )
             dist.barrier()
             self._apply_scheduler(result)
+        if self.profiler is not None:
+            self.profiler.close()
+        ## make sure the last checkpoint is written
+        self.ckpt_writer.wait()
@@ -0,0 +1,86 @@
+### DDP construction with the communication settings of the config
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook
+
+## the gradient compression hooks, they take (state, bucket)
+COMM_HOOKS = {
+    None: default_hooks.allreduce_hook,
+    "fp16": default_hooks.fp16_compress_hook,
+    "bf16": default_hooks.bf16_compress_hook,
+    "powersgd": powerSGD_hook.powerSGD_hook,
+}
+
+
+class TimedHookState:
+    def __init__(self, hook, hook_state):
+        """
+        The state of timed_hook, which wraps hook. The timer is set by the trainer.
+        """
+        self.hook = hook
+        self.hook_state = hook_state
+        self.timer = None
+
+
+def timed_hook(state: TimedHookState, bucket):
+    """
+    Run the wrapped hook and time each bucket from the start of its communication to its completion,
+    recorded as the allreduce phase of the step timer.
+    """
+    timer = state.timer
+    if timer is None or not timer.enabled:
+        return state.hook(state.hook_state, bucket)
+    start = timer.mark()
+    fut = state.hook(state.hook_state, bucket)
+
+    def done(fut):
+        timer.record("allreduce", start)
+        return fut.value()
+
+    return fut.then(done)
+
+
+def build_ddp(model, device, config):
+    """
+    Wrap the model with DDP according to the config:
+        find_unused: find_unused_parameters
+        bucket_cap_mb: the size of the gradient buckets, 25 by default
+        gradient_as_bucket_view: the gradients are views of the buckets, which saves a copy and memory
+        static_graph: the same parameters are used in every step, which allows more optimizations
+        comm_hook: the gradient compression [fp16, bf16, powersgd], none by default
+        powersgd_rank, powersgd_start_iter: the settings of powersgd
+        allreduce_timing: time the all-reduce of each step, which replaces the built-in all-reduce
+            with a python hook if there is no comm_hook
+    The hook of comm_hook is wrapped in timed_hook, which only measures the all-reduce time with
+    allreduce_timing and step_timing. Its state is the attribute comm_state of the returned model.
+    """
+    kwargs = dict(
+        device_ids=[device.index] if device.type == "cuda" else None,
+        find_unused_parameters=bool(config.find_unused),
+        gradient_as_bucket_view=bool(config.gradient_as_bucket_view),
+        static_graph=bool(config.static_graph),
+    )
+    if config.bucket_cap_mb is not None:
+        kwargs["bucket_cap_mb"] = config.bucket_cap_mb
+    model = DDP(model, **kwargs)
+    model.comm_state = None
+    if config.comm_hook is None and not config.allreduce_timing:
+        ## keep the built-in all-reduce, a python hook costs a callback per bucket
+        return model
+    assert (
+        config.comm_hook in COMM_HOOKS
+    ), f"comm_hook should be one of {list(COMM_HOOKS.keys())}"
+    hook_state = None
+    if config.comm_hook == "powersgd":
+        hook_state = powerSGD_hook.PowerSGDState(
+            process_group=None,
+            matrix_approximation_rank=config.powersgd_rank or 1,
+            start_powerSGD_iter=(
+                config.powersgd_start_iter
+                if config.powersgd_start_iter is not None
+                else 1000
+            ),
+        )
+    model.comm_state = TimedHookState(COMM_HOOKS[config.comm_hook], hook_state)
+    model.register_comm_hook(model.comm_state, timed_hook)
+    return model
@@ -1,8 +1,16 @@
 import os
 import os.path as op
 import re
+import copy
+import shutil
+import threading
+import random
+import math
+import numpy as np
 import torch
+import torch.distributed as dist
 from typing import Union
+from collections import defaultdict
 
 
 def dict_to_str(dictionary):
@@ -32,41 +40,285 @@ def normalize_result(result: dict, length: int):
     return result
 
 
+class MetricAggregator:
+    """
+    Accumulate scalar metric tensors on device in one flat tensor, weighted by the number of examples,
+    with the total count as the last element, so averaging over all ranks is a single all_reduce
+    and a single copy to the host.
+    """
+
+    def __init__(self):
+        self.keys = None
+        self.sums = None
+
+    def add(self, res: dict, num=1):
+        if self.keys is None:
+            self.keys = list(res.keys())
+        values = torch.stack([res[k].detach().double() for k in self.keys])
+        if self.sums is None:
+            self.sums = values.new_zeros(len(self.keys) + 1)
+        self.sums[:-1] += values * num
+        self.sums[-1] += num
+
+    def reduce(self):
+        """
+        Return the averages over all ranks as a dict of floats
+        """
+        if dist.is_initialized():
+            dist.all_reduce(self.sums)
+        sums = self.sums.tolist()
+        return {k: v / sums[-1] for k, v in zip(self.keys, sums[:-1])}
+
+
+class AsyncMetrics:
+    """
+    Copy a dict of scalar metric tensors to the host without waiting for the device,
+    result() only blocks if the copy is not done yet, e.g. when it is logged one log interval later.
+    """
+
+    def __init__(self, res: dict, **info):
+        self.keys = list(res.keys())
+        self.info = info
+        values = torch.stack([res[k].detach().float() for k in self.keys])
+        self.event = None
+        if values.is_cuda:
+            self.values = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+            self.values.copy_(values, non_blocking=True)
+            self.event = torch.cuda.Event()
+            self.event.record()
+        else:
+            self.values = values
+
+    def result(self):
+        if self.event is not None:
+            self.event.synchronize()
+        res = dict(zip(self.keys, self.values.tolist()))
+        res.update(self.info)
+        return res
+
+
+def get_rng_state():
+    """
+    The states of all the random number generators of this process
+    """
+    state = {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state: dict):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state.get("cuda") is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def _ckpt_key(name):
+    """
+    (epoch, step) of epoch<e>.pth or epoch<e>_step<s>.pth,
+    the checkpoint at the end of an epoch comes after all the step checkpoints of the epoch
+    """
+    numbers = [int(n) for n in re.findall(r"[0-9]+", name)]
+    return (numbers[0], numbers[1] if len(numbers) > 1 else float("inf"))
+
+
+def _ckpt_files(dirname):
+    """
+    The checkpoints in dirname except the best one, from the oldest to the newest
+    """
+    return sorted(
+        [f for f in os.listdir(dirname) if (f.endswith(".pth") and "best" not in f)],
+        key=_ckpt_key,
+    )
+
+
 def save(path, content, max_ckpt=1):
-    # if len(files_path) >= max_ckpt:
+    """
+    Save the checkpoint to a temporary file and atomically rename it to path.
+    Only after the new checkpoint is written, the oldest ones are removed to keep max_ckpt checkpoints.
+    """
+    tmp_path = path + ".tmp"
+    torch.save(content, tmp_path)
+    os.replace(tmp_path, path)
     if max_ckpt == -1:
-        ##save
-        torch.save(content, path)
         return
     if max_ckpt == None:
         max_ckpt = 1
     dirname = op.dirname(path)
-    files = sorted(
-        [f for f in os.listdir(dirname) if (f.endswith(".pth") and "best" not in f)],
-        key=lambda x: int(re.search(r"[0-9]+", x).group()),
-    )
-    files_path = [op.join(dirname, f) for f in files]
-    if len(files_path) >= max_ckpt:
+    files_path = [
+        op.join(dirname, f) for f in _ckpt_files(dirname) if f != op.basename(path)
+    ]
+    for f in files_path[: max(len(files_path) + 1 - max_ckpt, 0)]:
         try:
-            os.remove(files_path[0])
+            os.remove(f)
         except FileNotFoundError as e:
             print("saving error")
             print(e)
-    torch.save(content, path)
+
+
+def link_best(path, best_path):
+    """
+    Make best_path a hard link of the checkpoint at path, or a copy if links are not supported.
+    The link is made to a temporary file first and renamed, so best_path is always complete.
+    """
+    tmp_path = best_path + ".tmp"
+    if op.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, best_path)
+
+
+def to_cpu(obj):
+    """
+    Snapshot obj for saving: tensors are copied to cpu, containers are copied recursively
+    and other objects are deep copied, so training can go on while it is written.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if type(obj) in (list, tuple):
+        return type(obj)(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints in a background thread, one at a time.
+    Errors of the background write are raised on the next submit() or wait().
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def _write(self, path, content, max_ckpt, best_path):
+        try:
+            save(path, content, max_ckpt)
+            if best_path is not None:
+                link_best(path, best_path)
+        except Exception as e:
+            self.error = e
+
+    def submit(self, path, content, max_ckpt=1, best_path=None):
+        """
+        content should already be a snapshot (see to_cpu) that is not modified by training
+        """
+        self.wait()
+        self.thread = threading.Thread(
+            target=self._write, args=(path, content, max_ckpt, best_path)
+        )
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def torch_load(path: str):
+    """
+    Load a checkpoint on cpu with the tensors memory mapped from the file, so they are only read when used
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        ## checkpoints of the legacy format can not be memory mapped
+        return torch.load(path, map_location="cpu")
+
+
+class _TensorRef:
+    def __init__(self, index):
+        self.index = index
+
+
+def _split_tensors(obj, tensors: list):
+    """
+    Replace the tensors of obj by references to their index in tensors
+    """
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return _TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        return {k: _split_tensors(v, tensors) for k, v in obj.items()}
+    if type(obj) in (list, tuple):
+        return type(obj)(_split_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _join_tensors(obj, tensors: list):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return {k: _join_tensors(v, tensors) for k, v in obj.items()}
+    if type(obj) in (list, tuple):
+        return type(obj)(_join_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def broadcast_ckpt(ckpt, rank: int, device, chunk_bytes=2**28):
+    """
+    Broadcast the checkpoint loaded by rank 0 (None on the other ranks) to all the ranks, returned on cpu.
+    Everything but the tensors is broadcast as one object, and the tensors as flat buffers
+    of the same dtype of at most chunk_bytes each, so only rank 0 reads the file.
+    """
+    header = [None]
+    if rank == 0:
+        tensors = []
+        skeleton = _split_tensors(ckpt, tensors)
+        header = [(skeleton, [(t.dtype, t.shape) for t in tensors])]
+    dist.broadcast_object_list(header, src=0, device=device)
+    skeleton, metas = header[0]
+    out = [None] * len(metas)
+    by_dtype = defaultdict(list)
+    for i, (dtype, _) in enumerate(metas):
+        by_dtype[dtype].append(i)
+    for dtype, idxes in by_dtype.items():
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        chunks, chunk, size = [], [], 0
+        for i in idxes:
+            numel = math.prod(metas[i][1])
+            if chunk and (size + numel) * itemsize > chunk_bytes:
+                chunks.append(chunk)
+                chunk, size = [], 0
+            chunk.append(i)
+            size += numel
+        chunks.append(chunk)
+        for chunk in chunks:
+            numels = [math.prod(metas[i][1]) for i in chunk]
+            if rank == 0:
+                buf = torch.cat([tensors[i].reshape(-1) for i in chunk]).to(device)
+            else:
+                buf = torch.empty(sum(numels), dtype=dtype, device=device)
+            dist.broadcast(buf, src=0)
+            buf = buf.cpu()
+            for i, t in zip(chunk, buf.split(numels)):
+                out[i] = t.view(metas[i][1])
+    return _join_tensors(skeleton, out)
 
 
 def load_ckpt(ckpt_dir: str):
     """
     ckpt dir: the directory to the checkpoint folder
+    The newest checkpoint is the one of the latest epoch, and of the latest step within an epoch.
     continue_from: if string, return the string (path)
         if boolean, if true: return the latest epoch ckpt path in ckpt_dir or None if there is no ckpt available
                     if false: return None
         if None: return the latest epoch ckpt path in ckpt_dir or None if there is no ckpt available
     """
-    files = sorted(
-        [f for f in os.listdir(ckpt_dir) if (f.endswith(".pth") and "best" not in f)],
-        key=lambda x: int(re.search(r"[0-9]+", x).group()),
-    )
+    files = _ckpt_files(ckpt_dir)
     if len(files) == 0:
         return None
     else:
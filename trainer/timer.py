@@ -0,0 +1,128 @@
+### Step-level timing of the training loop
+import time
+import contextlib
+from collections import defaultdict
+import torch
+
+
+class StepTimer:
+    """
+    Time the phases of the training steps, e.g. data, h2d, tokenize, forward, backward and optim.
+    On cuda the phases are timed with pairs of events, which are only read when the interval
+    is resolved, so timing does not sync the device. Otherwise they are timed with perf_counter.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.use_events = enabled and torch.device(device).type == "cuda"
+        self.reset()
+
+    def reset(self):
+        self.host = defaultdict(float)
+        self.events = []
+        self.batches = 0
+        self.samples = 0
+        self.start = time.perf_counter()
+        if self.use_events:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.use_events:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.events.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self.host[name] += time.perf_counter() - start
+
+    def mark(self):
+        """
+        The start of a phase that ends in a callback, see record()
+        """
+        if self.use_events:
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+            return start
+        return time.perf_counter()
+
+    def record(self, name, start):
+        """
+        End the phase started with mark(), e.g. in the callback of a communication future
+        """
+        if self.use_events:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.events.append((name, start, end))
+        else:
+            self.host[name] += time.perf_counter() - start
+
+    def iterate(self, loader, name="data"):
+        """
+        Iterate over the loader, timing the wait for each batch on the host
+        """
+        it = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                data = next(it)
+            except StopIteration:
+                return
+            self.host[name] += time.perf_counter() - start
+            yield data
+
+    def batch_done(self, samples):
+        self.batches += 1
+        self.samples += samples
+
+    def interval(self):
+        """
+        Close the current interval and return it, to be resolved with result() later
+        """
+        peak_mem = (
+            torch.cuda.max_memory_allocated(self.device) if self.use_events else None
+        )
+        interval = TimerInterval(
+            self.host,
+            self.events,
+            self.batches,
+            self.samples,
+            time.perf_counter() - self.start,
+            peak_mem,
+        )
+        self.reset()
+        return interval
+
+
+class TimerInterval:
+    def __init__(self, host, events, batches, samples, seconds, peak_mem):
+        self.host = host
+        self.events = events
+        self.batches = batches
+        self.samples = samples
+        self.seconds = seconds
+        self.peak_mem = peak_mem
+
+    def result(self):
+        """
+        Return the average ms per batch of each phase, the samples per second
+        and the peak memory of the interval
+        """
+        times = {k: v * 1000 for k, v in self.host.items()}
+        for name, start, end in self.events:
+            end.synchronize()
+            times[name] = times.get(name, 0.0) + start.elapsed_time(end)
+        batches = max(self.batches, 1)
+        res = {f"{k}_ms": v / batches for k, v in times.items()}
+        res["samples/s"] = self.samples / self.seconds
+        if self.peak_mem is not None:
+            res["mem/peak_gb"] = self.peak_mem / 2**30
+        return res
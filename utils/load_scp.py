@@ -1,4 +1,5 @@
 import os
+import os.path as op
 
 
 def get_source_list(file_path: str, ret_name=False):
@@ -14,3 +15,23 @@ def get_source_list(file_path: str, ret_name=False):
     if ret_name:
         return names, files
     return files
+
+
+def get_source_lengths(file_path: str):
+    """
+    Return the number of samples of each audio in the scp file.
+    It is read from the .len file next to the scp file (generated by data/generate_list.py) if it exists,
+    otherwise from the audio headers.
+    """
+    len_path = op.splitext(file_path)[0] + ".len"
+    if op.exists(len_path):
+        lengths = {}
+        with open(len_path, "r") as f:
+            for line in f.readlines():
+                name, num_samples = line.split()
+                lengths[name] = int(num_samples)
+        names = get_source_list(file_path, ret_name=True)[0]
+        return [lengths[name] for name in names]
+    import torchaudio
+
+    return [torchaudio.info(path).num_frames for path in get_source_list(file_path)]
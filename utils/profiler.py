@@ -0,0 +1,107 @@
+### torch.profiler with scheduled capture windows
+import os
+import os.path as op
+import signal
+import torch
+from torch.profiler import profile, schedule, ProfilerActivity
+
+
+class Profiler:
+    def __init__(
+        self,
+        out_dir: str,
+        rank: int = 0,
+        name: str = "train",
+        wait: int = 1,
+        warmup: int = 1,
+        active: int = 3,
+        record_shapes=False,
+        profile_memory=False,
+        with_stack=False,
+        steps=None,
+        signal_name="SIGUSR1",
+    ):
+        """
+        Capture windows of wait + warmup + active steps with torch.profiler, without profiling the rest of the run.
+        The traces are exported to <out_dir>/<name>_rank<rank>_step<step>.pt.trace.json with a summary table
+        of the operators in the .txt of the same name, where step is the step the capture started at.
+
+        Arguments:
+            wait, warmup, active: the schedule of torch.profiler of each capture
+            record_shapes, profile_memory, with_stack: passed to torch.profiler.profile
+            steps: the list of steps to start a capture at
+            signal_name: start a capture at the next step when the process gets this signal,
+                e.g. kill -USR1 <pid of the rank>, see config/README.md for whole jobs.
+                None to not install the signal handler
+        """
+        self.out_dir = out_dir
+        self.rank = rank
+        self.name = name
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        self.steps = set(int(s) for s in steps) if steps is not None else set()
+        self.requested = False
+        self.prof = None
+        self.remaining = 0
+        os.makedirs(out_dir, exist_ok=True)
+        if signal_name is not None:
+            signal.signal(getattr(signal, signal_name), self._request)
+
+    def _request(self, signum, frame):
+        ## only set a flag, the capture starts at the next step
+        self.requested = True
+
+    def _activities(self):
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        return activities
+
+    def _start(self, step):
+        path = op.join(self.out_dir, f"{self.name}_rank{self.rank}_step{step}")
+        print(f"rank {self.rank}: profiling from step {step} to {path}.pt.trace.json")
+
+        def on_trace_ready(prof):
+            prof.export_chrome_trace(f"{path}.pt.trace.json")
+            sort_by = (
+                "self_cuda_time_total"
+                if torch.cuda.is_available()
+                else "self_cpu_time_total"
+            )
+            with open(f"{path}.txt", "w") as f:
+                f.write(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+
+        self.prof = profile(
+            activities=self._activities(),
+            schedule=schedule(
+                wait=self.wait, warmup=self.warmup, active=self.active, repeat=1
+            ),
+            on_trace_ready=on_trace_ready,
+            record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack,
+        )
+        self.prof.start()
+        self.remaining = self.wait + self.warmup + self.active
+
+    def step(self, step: int):
+        """
+        Called at the start of every step with the step number
+        """
+        if self.prof is not None:
+            self.prof.step()
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.close()
+        if self.prof is None and (step in self.steps or self.requested):
+            self.requested = False
+            self._start(step)
+
+    def close(self):
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
@@ -3,7 +3,7 @@ import random
 import torch.nn.functional as F
 
 
-def truc_wav(*audio: torch.Tensor, length):
+def truc_wav(*audio: torch.Tensor, length, rng=None):
     """
     Given a list of audio with the same length as arguments, chunk the audio into a given length.
     Note that all the audios will be chunked using the same offset
@@ -11,6 +11,7 @@ def truc_wav(*audio: torch.Tensor, length):
     Args:
         audio: the list of audios to be chunked, should have the same length with shape [T] (1D)
         length: the length to be chunked into, if length is None, return the original audio
+        rng: the random.Random to draw the offset from, the global random module if None
     Returns:
         A list of chuncked audios
     """
@@ -21,7 +22,7 @@ def truc_wav(*audio: torch.Tensor, length):
             res.append(a)
         return res[0] if len(res) == 1 else res
     if audio_len > length:
-        offset = random.randint(0, audio_len - length - 1)
+        offset = (random if rng is None else rng).randint(0, audio_len - length - 1)
         for a in audio:
             res.append(a[offset : offset + length])
     else: